@@ -1,13 +1,33 @@
 import time
 import threading
-import copy
-from Queue import Queue, PriorityQueue
+import functools
+from array import array
+from collections import deque
+from Queue import PriorityQueue
 
-from log import LOG
+from transposition import TranspositionTable
+from metrics import METRICS
+from tracing import get_tracer
+
+TRACE = get_tracer("search")
+
+# share of the time left before the next gravity tick that a search can
+# take, with an empty board and with the stack at the top. The higher the
+# stack, the more a missed tick hurts, so the more time is kept as margin
+SEARCH_TIME_SHARE = 0.8
+DANGER_SEARCH_TIME_SHARE = 0.3
+# searches always get at least this many seconds
+MIN_SEARCH_TIME = 0.002
 
 class TetrisAI(object):
-    def __init__(self, engine):
+    def __init__(self, engine, algorithm_class=None, evaluator=None):
+        """
+        `evaluator`, if given, is the BoardEvaluator the searches score
+        the boards with (tuned weights, see tuner.py).
+        """
         self.engine = engine
+        self.algorithm_class = _with_evaluator(
+            algorithm_class or PossiblePlacementsAlgorithm, evaluator)
         self._thread = threading.Thread(target=self._run_thread,
                                         name="AIThread")
 
@@ -15,46 +35,143 @@ class TetrisAI(object):
         self._thread.start()
 
     def _run_thread(self):
-        global e
-        e = self.engine
         while self.engine.running():
-            #x = copy.deepcopy(self.engine.game_state)
-            algorithm = PossibleStatesBFSAlgorithm(self.engine.game_state)
+            a = time.time()
+            game_state = self.engine.snapshot()
+            budget = SearchBudget.for_drop(game_state,
+                                           self.engine.time_to_drop(),
+                                           running=self.engine.running)
+            algorithm = self.algorithm_class(game_state, budget=budget)
             algorithm.go()
-            #e.set_game_state(x)
 
-            path = algorithm.optimal_path
+            # the path is only good for the state it was searched from,
+            # which gravity may have changed in the meantime
+            self.engine.execute(algorithm.optimal_path, time.time()-a,
+                                expected=game_state.drop_state())
+
+
+class AsyncTetrisAI(object):
+    """
+    TetrisAI for an engine.AsyncTetrisEngine: the search runs on the
+    executor of the engine's loop, on a copy of the game state, and the
+    path it finds is played on the loop.
+    """
+    def __init__(self, engine, algorithm_class=None, evaluator=None):
+        self.engine = engine
+        self.algorithm_class = _with_evaluator(
+            algorithm_class or PossiblePlacementsAlgorithm, evaluator)
+
+    def play(self):
+        self.engine.loop.call_soon(self._search)
+
+    def _search(self):
+        if not self.engine.running():
+            return
 
-            for action in path:
-                if isinstance(action, MakeMove):
-                    d = action.direction
-                    for i in range(action.times):
-                        if d == Direction.DOWN:
-                            self.engine.move_down()
-                        elif d == Direction.RIGHT:
-                            self.engine.move_right()
-                        elif d == Direction.LEFT:
-                            self.engine.move_left()
-                        #time.sleep(0.1)
-                elif isinstance(action, Rotate):
-                    self.engine.rotate()
-                #time.sleep(0.1)
+        game_state = self.engine.game_state.copy()
+        budget = SearchBudget.for_drop(game_state, self.engine.time_to_drop(),
+                                       running=self.engine.running)
+        self.engine.loop.run_in_executor(
+            functools.partial(self._search_done, game_state),
+            self._find_path, game_state, budget)
 
-            self.engine.move_down()
-            #time.sleep(1)
+    def _find_path(self, game_state, budget):
+        """
+        Returns (path, seconds it took to find it).
+        """
+        a = time.time()
+        algorithm = self.algorithm_class(game_state, budget=budget)
+        algorithm.go()
+        return algorithm.optimal_path, time.time()-a
+
+    def _search_done(self, game_state, result):
+        if not self.engine.running():
+            return
+
+        # the path is only good for the state it was searched from, which
+        # gravity may have changed in the meantime
+        self.engine.execute(*result, expected=game_state.drop_state())
+        self._search()
+
+
+def _with_evaluator(algorithm_class, evaluator):
+    if evaluator is None:
+        return algorithm_class
+    return functools.partial(algorithm_class, evaluator=evaluator)
+
+
+class SearchBudget(object):
+    """
+    How much a search may do: run until `deadline` (a time.time() value),
+    count at most `max_nodes` nodes (what a node is depends on the search)
+    and go on while `running()`, if given, returns True. Any of them can be
+    None for no limit.
+
+    Searches given a budget are anytime: when it runs out they stop and
+    keep the best result found so far.
+    """
+    def __init__(self, deadline=None, max_nodes=None, running=None):
+        self.deadline = deadline
+        self.max_nodes = max_nodes
+        self.running = running
+
+    @classmethod
+    def for_drop(cls, game_state, time_left, max_nodes=None, running=None):
+        """
+        Budget to decide the move of `game_state.drop_block` with
+        `time_left` seconds before the next gravity tick: a share of that
+        time, smaller the closer the stack is to the top.
+        """
+        board = game_state.board
+        top = max(board.column_height(x) for x in xrange(board.width))
+        danger = min(float(top) / board.height, 1.0)
+        share = SEARCH_TIME_SHARE - \
+            (SEARCH_TIME_SHARE - DANGER_SEARCH_TIME_SHARE) * danger
+        return cls(time.time() + max(time_left * share, MIN_SEARCH_TIME),
+                   max_nodes, running)
+
+    def exhausted(self, nodes=0):
+        """
+        True if a search that counted `nodes` nodes must stop.
+        """
+        if self.max_nodes is not None and nodes >= self.max_nodes:
+            return True
+        if self.deadline is not None and time.time() >= self.deadline:
+            return True
+        return self.running is not None and not self.running()
+
+    def __getstate__(self):
+        # `running` is usually an engine method, which can't be pickled
+        # nor makes sense in another process
+        state = self.__dict__.copy()
+        state["running"] = None
+        return state
+
+    def __str__(self):
+        return "<SearchBudget: deadline=%s, max_nodes=%s>" % (self.deadline,
+                                                             self.max_nodes)
 
 
 class PossibleStatesBFSAlgorithm(object):
-    def __init__(self, game_state):
+    def __init__(self, game_state, budget=None):
+        """
+        With a `budget` (a SearchBudget, counting the nodes expanded) the
+        search stops when it runs out, with the placements found until
+        then.
+        """
         self.original_game_state = game_state
+        self.budget = budget
 
         self._results_queue = PriorityQueue()
         self.best_result = None
         self.optimal_path = []
+        # True if the last search ran out of budget
+        self.budget_exhausted = False
 
     def go(self):
-        game_state = copy.deepcopy(self.original_game_state)
-        self._run_bfs(game_state)
+        game_state = self.original_game_state.copy()
+        with METRICS.timer("search.time"):
+            self._run_bfs(game_state)
 
         if self._results_queue.qsize() > 0:
             self.best_result = self._results_queue.queue[0]
@@ -113,144 +230,752 @@ class PossibleStatesBFSAlgorithm(object):
 
 
     def _run_bfs(self, game_state):
-        start_time = time.time()
-        total = 0
-        queue = Queue()
-        visited_nodes = {}
-
-        start_drop_node = BoardNode(game_state.drop_block,
-                                    game_state.drop_position)
-        bfs_start_pos, actions = self._get_bfs_start_pos(game_state)
-
-        node = BoardNode(game_state.drop_block, bfs_start_pos,
-                        start_drop_node, actions)
-        #node = BoardNode(block, game_state.drop_position)
-        queue.put(node)
-
-        while not queue.empty() and e.running():
-            node = queue.get()
-
-            if visited_nodes.has_key(node):
-                continue
-
-            visited_nodes[node] = True
-            game_state.drop_position = node.drop_position
-
-            # we need to have a copy of drop_block because it will be changed
-            # with rotations
-            game_state.drop_block = copy.copy(node.drop_block)
-
-
-
-            LOG.debug("Current node: %s" % node)
-            #e.set_game_state(game_state)
-            #e.print_game()
-
-            if game_state.rotate_block():
-                new_node = BoardNode(game_state.drop_block,
-                                    game_state.drop_position,
-                                    node,
-                                    [Rotate()])
-                queue.put(new_node)
-                # there's NO need to make a new copy of node.drop_block as
-                # with the time of writing of this code the game_state.drop_block
-                # isn't modified anywhere again in code.
-                # if this changes, game_state.drop_block MUST be
-                # assigned to a new copy of node.drop_block
-                game_state.drop_block = node.drop_block
-
-            if game_state.move_block_left():
-                new_node = BoardNode(game_state.drop_block,
-                                     game_state.drop_position,
-                                     node,
-                                     [MakeMove(Direction.LEFT)])
-                queue.put(new_node)
-                game_state.drop_position = node.drop_position
-
-            if game_state.move_block_right():
-                new_node = BoardNode(game_state.drop_block,
-                                     game_state.drop_position,
-                                     node,
-                                     [MakeMove(Direction.RIGHT)])
-                queue.put(new_node)
-                game_state.drop_position = node.drop_position
-
-
-            if game_state.drop_block_is_stuck():
-                a = time.time()
-                path = self._get_path(node)
-                b = (time.time()-a)*1000
-                total += b
-                #LOG.debug("Time calcing path: %f" % b)
+        board = game_state.board
+        drop_block = game_state.drop_block
+        flyweights = drop_block.flyweights
+        x0, y0 = game_state.drop_position
+
+        space = StateSpace(flyweights, board.width, max(board.height, y0+1))
+        encode = space.encode
+
+        # states already queued, and the previous state and the action
+        # that got to each one
+        visited = bytearray(space.size)
+        parents = array("i", [0]) * space.size
+        actions = bytearray(space.size)
+
+        start = encode(drop_block.rotation, x0, y0)
+        bfs_start_pos, start_actions = self._get_bfs_start_pos(game_state)
+        state = encode(drop_block.rotation, *bfs_start_pos)
+        visited[state] = 1
+        parents[state] = start
+        actions[state] = START
+        queue = deque([state])
+
+        moves = ((game_state.rotate_block, ROTATE),
+                 (game_state.move_block_left, LEFT),
+                 (game_state.move_block_right, RIGHT),
+                 (game_state.move_block_down, DOWN))
+
+        budget = self.budget
+        nodes = 1
+        expanded = 0
+        duplicates = 0
+        while queue:
+            if budget is not None and budget.exhausted(expanded):
+                self.budget_exhausted = True
+                METRICS.counter("search.budget_exhausted").inc()
+                break
+            expanded += 1
+
+            state = queue.popleft()
+            rotation, x, y = space.decode(state)
+            block = flyweights[rotation]
+            position = (x, y)
+            game_state.drop_block = block
+            game_state.drop_position = position
+
+            TRACE.sampled("Current node: %s at %s", block, position)
+
+            stuck = game_state.drop_block_is_stuck()
+            for move, action in moves:
+                # move_block_down() would place a stuck block
+                if action == DOWN and stuck:
+                    continue
+                if not move():
+                    continue
+
+                # rotate_block() doesn't change the block itself, it swaps
+                # game_state.drop_block by the shared rotated instance
+                moved = encode(game_state.drop_block.rotation,
+                               *game_state.drop_position)
+                game_state.drop_block = block
+                game_state.drop_position = position
+
+                if visited[moved]:
+                    duplicates += 1
+                    continue
+                visited[moved] = 1
+                parents[moved] = state
+                actions[moved] = action
+                queue.append(moved)
+                nodes += 1
+
+            if stuck:
+                path = self._get_path(parents, actions, start, start_actions,
+                                      state)
                 s = PossibleBlockState(game_state, path)
                 s.calc_stats()
                 self._results_queue.put(s)
-            else:
-                # block is not stuck, so move_block_down() will return boolean
-                # indicating either if the move is valid of not
-                # it only returns an integer representing the nr of lines done
-                # when it's called in a stuck position
-                if game_state.move_block_down():
-                    new_node = BoardNode(game_state.drop_block,
-                                        game_state.drop_position,
-                                        node,
-                                        [MakeMove(Direction.DOWN)])
-                    queue.put(new_node)
-                    game_state.drop_position = node.drop_position
-
-            #time.sleep(0.1)
-
-        #LOG.debug("ALL TIME: %f" % ((time.time()-start_time)*1000))
-        #LOG.debug("total paths time: %f" % total)
-
-    def _get_path(self, end_node):
-        #LOG.debug("End node: %s" % end_node)
-        path = []
 
-        node = end_node
-        while node.previous_node:
-            for a in node.previous_actions:
-                path.insert(0, a)
+        METRICS.counter("search.nodes").inc(nodes)
+        METRICS.counter("search.duplicate_nodes").inc(duplicates)
+        METRICS.average("search.placements").add(self._results_queue.qsize())
 
-            node = node.previous_node
+    def _get_path(self, parents, actions, start, start_actions, state):
+        actions_done = []
+        while state != start:
+            action = actions[state]
+            if action == START:
+                actions_done.extend(reversed(start_actions))
+            else:
+                actions_done.append(_path_action(action))
+            state = parents[state]
+        actions_done.reverse()
 
-        LOG.debug("PATH: %s" % path)
-        LOG.debug("Start node: %s" % node)
+        path = compact_path(actions_done, stuck=True)
+        TRACE.sampled("Path: %s", path)
         return path
 
 
-class BoardNode(object):
-    def __init__(self, drop_block, drop_position,
-                previous_node=None, previous_actions=[]):
-        self.drop_block = drop_block
-        self.drop_position = drop_position
+class StateSpace(object):
+    """
+    Dense encoding of the (rotation, x, y) states of a block as integers,
+    `rotation*W*H + x*H + y`, so that searches keep what they know about
+    each state in flat buffers (bytearray, array) indexed by state, not in
+    dicts of tuples or node objects.
+
+    W and H are the board width and height padded on every side by the
+    size of the block, so the states next to any state where the block
+    fits (a column, a row or a rotation away) are valid indexes too.
+    Moving left or right is adding -H or H to a state, moving down -1.
+    """
+    __slots__ = ("rotations", "padding", "width", "height", "rotation_size",
+                 "size")
+
+    def __init__(self, flyweights, width, height):
+        self.rotations = len(flyweights)
+        self.padding = max(max(b.width, b.height) for b in flyweights)
+        self.width = width + 2*self.padding
+        self.height = height + 2*self.padding
+        self.rotation_size = self.width * self.height
+        self.size = self.rotations * self.rotation_size
+
+    def encode(self, rotation, x, y):
+        return (rotation*self.width + x + self.padding)*self.height + \
+            y + self.padding
+
+    def decode(self, state):
+        """
+        Returns (rotation, x, y).
+        """
+        rotation_x, y = divmod(state, self.height)
+        rotation, x = divmod(rotation_x, self.width)
+        return rotation, x - self.padding, y - self.padding
+
+
+class PossiblePlacementsAlgorithm(object):
+    """
+    Finds every reachable final placement of the drop block directly,
+    without going through the GameState movement methods, and picks the
+    best one.
+
+    The search has two phases:
+
+        - a column sweep: for each rotation reachable at the drop position,
+          the block is slid left and right along the drop row and then
+          dropped straight down each column. Every state found this way is
+          reached with the least possible number of inputs (the rotations,
+          the horizontal distance and the vertical distance, or a single
+          hard drop for the bottom of the column).
+
+        - a reachability pass, only if the board has holes (without
+          them every placement can be dropped into straight), unless some
+          rotation or slide wasn't possible at the drop row: starting from
+          the swept states next to a hole or at the bottom of a column, a
+          BFS by number of inputs follows LEFT, RIGHT, DOWN, hard drops and
+          rotations to find the tucks and slides under overhangs.
+
+    A hard drop counts as one input and only moves the block: it's placed
+    when the path ends, so paths can drop and then tuck. Paths are only
+    built for the placements that ask for them.
+    """
+    def __init__(self, game_state, budget=None, evaluator=None):
+        """
+        With an `evaluator` (a BoardEvaluator, e.g. with tuned weights) the
+        best placement is the one leading to the best board for it,
+        otherwise the one touching the most squares (see
+        PossibleBlockState). With a `budget` (a SearchBudget, counting the
+        placements scored) only the placements scored before it runs out
+        are considered.
+        """
+        self.original_game_state = game_state
+        self.budget = budget
+        self.evaluator = evaluator
+
+        self.placements = []
+        self.best_result = None
+        self.optimal_path = []
+        # True if the last search ran out of budget
+        self.budget_exhausted = False
+
+        # number of (rotation, x, y) states reached by the last search, and
+        # of times it got to states it already knew
+        self.visited_states = 0
+        self.duplicate_states = 0
+
+    def go(self):
+        with METRICS.timer("search.time"):
+            self._search()
+
+    def _search(self):
+        game_state = self.original_game_state.copy()
+        self.placements = self.find_placements(game_state)
+        if self.budget is not None:
+            # the lowest placements tend to be the best ones, they're
+            # scored first in case the budget runs out
+            self.placements.sort(key=lambda p: p.y)
+
+        with METRICS.timer("search.evaluation_time"):
+            if self.evaluator is None:
+                self.best_result = self._most_connected(game_state)
+            else:
+                ranked = self.rank(game_state, self.placements)
+                if ranked:
+                    placement, lines_done, board_score = ranked[0]
+                    self.best_result = BeamNode(
+                        [placement], lines_done, board_score +
+                        self.evaluator.weights["lines"] * lines_done)
+
+        if self.best_result is not None:
+            self.optimal_path = self.best_result.path
 
-        self.previous_node = previous_node
-        self.previous_actions = previous_actions
+    def _most_connected(self, game_state):
+        """
+        Returns the PossibleBlockState of the placement touching the most
+        squares, the lowest one on ties, or None.
+        """
+        results = []
+        for placement in self.placements:
+            game_state.drop_block = placement.block
+            game_state.drop_position = (placement.x, placement.y)
+            s = PossibleBlockState(game_state, None, placement)
+            s.calc_stats()
+            results.append(s)
+
+            if self.out_of_budget(len(results),
+                                   len(results) < len(self.placements)):
+                break
+        return min(results) if results else None
+
+    def rank(self, game_state, placements, nodes=0):
+        """
+        Returns a list of (placement, lines done, board score) for
+        `placements` of the drop block of `game_state`, the best first,
+        scored with the evaluator. With a budget, only the placements
+        scored before it runs out, counting them after `nodes`.
+        """
+        evaluator = self.evaluator or DEFAULT_EVALUATOR
+        ranked = []
+        for placement in placements:
+            record = game_state.apply_placement(placement.block,
+                                                (placement.x, placement.y))
+            ranked.append((placement, record.lines_done,
+                           evaluator.evaluate_board(game_state.board)))
+            game_state.undo(record)
+
+            if self.out_of_budget(nodes + len(ranked),
+                                   len(ranked) < len(placements)):
+                break
+
+        w_lines = evaluator.weights["lines"]
+        ranked.sort(key=lambda r: r[2] + w_lines * r[1], reverse=True)
+        return ranked
+
+    def out_of_budget(self, nodes=0, left=True):
+        """
+        True if the search must stop after counting `nodes` nodes. `left`
+        tells if there was still something to do, which makes the search
+        one that ran out of budget.
+        """
+        if self.budget is None or not self.budget.exhausted(nodes):
+            return False
+        if left and not self.budget_exhausted:
+            self.budget_exhausted = True
+            METRICS.counter("search.budget_exhausted").inc()
+        return True
+
+    def find_placements(self, game_state):
+        """
+        Returns a list of Placement, one per reachable final position of
+        `game_state.drop_block`, each one with a minimal input path from
+        the current drop position. If the budget runs out, tucks and
+        slides that weren't found by then are missing.
+        """
+        board = game_state.board
+        drop_block = game_state.drop_block
+        total_rotations = drop_block.total_rotations
+        flyweights = drop_block.flyweights
+        x0, y0 = game_state.drop_position
+
+        space = StateSpace(flyweights, board.width, max(board.height, y0+1))
+        decode = space.decode
+        # what moving a column or rotating adds to a state
+        column = space.height
+        rotation = space.rotation_size
+        last_rotation = (total_rotations-1) * rotation
+
+        # 0 if not known yet, 1 if the block fits, 2 if it doesn't
+        fits_cache = bytearray(space.size)
+        def fits(state):
+            f = fits_cache[state]
+            if not f:
+                r, x, y = decode(state)
+                f = fits_cache[state] = \
+                    1 if board.block_fits(flyweights[r], (x, y)) else 2
+            return f == 1
+
+        # number of inputs to get to each state (UNVISITED if it wasn't
+        # reached), previous state and action
+        costs = bytearray([UNVISITED]) * space.size
+        parents = array("i", [0]) * space.size
+        actions = bytearray(space.size)
+        states = []
+        duplicates = 0
+
+        start = space.encode(drop_block.rotation, x0, y0)
+        costs[start] = 0
+        states.append(start)
+
+        # column sweep
+        state = start
+        swept_rotations = 0
+        # lowest state of each column
+        landings = []
+        for times in xrange(total_rotations):
+            if times > 0:
+                rotated = state + rotation if state < last_rotation \
+                    else state - last_rotation
+                if not fits(rotated):
+                    break
+                costs[rotated] = times
+                parents[rotated] = state
+                actions[rotated] = ROTATE
+                states.append(rotated)
+                state = rotated
+            swept_rotations += 1
+
+            row = [state]
+            for step, action in ((-column, LEFT), (column, RIGHT)):
+                previous = state
+                while True:
+                    moved = previous + step
+                    if costs[moved] != UNVISITED:
+                        duplicates += 1
+                        break
+                    if not fits(moved):
+                        break
+                    costs[moved] = costs[previous]+1
+                    parents[moved] = previous
+                    actions[moved] = action
+                    states.append(moved)
+                    row.append(moved)
+                    previous = moved
+
+            for top_state in row:
+                previous = top_state
+                while fits(previous-1):
+                    moved = previous-1
+                    costs[moved] = costs[previous]+1
+                    parents[moved] = previous
+                    actions[moved] = DOWN
+                    states.append(moved)
+                    previous = moved
+                if previous < top_state-1:
+                    costs[previous] = costs[top_state]+1
+                    parents[previous] = top_state
+                    actions[previous] = HARD_DROP
+                landings.append(previous)
+
+        # reachability pass, processing states by number of inputs.
+        # If some rotation couldn't be done at the drop position (e.g. the
+        # rotated block would be entirely above the board) it may still be
+        # possible further down, and if the stack reaches the drop row it
+        # may block slides that other rotations can do, so every swept
+        # state must be expanded.
+        # Otherwise, something the sweep missed has a square in a hole, so
+        # it's found by a slide or a rotation from a swept state as low as
+        # the highest hole. Hard drops to the bottom of a column and a slide
+        # may beat moving down row by row, so those states are expanded
+        # too, and the states they get to with less inputs than the sweep.
+        top = max(board.column_height(x) for x in xrange(board.width))
+        if swept_rotations < total_rotations or top > y0:
+            seeds = states
+        elif board.holes:
+            # the highest hole can't be above the next to last square of
+            # its column
+            holes_y = max(board.column_height(x) - 2
+                          for x in xrange(board.width)
+                          if board.column_holes[x]) + space.padding
+            seeds = [s for s in states if s % column <= holes_y]
+            seeds += [s for s in landings if s % column > holes_y]
+        else:
+            seeds = ()
+
+        # lowest state straight below each state, -1 if not known yet
+        bottoms = array("i", [-1]) * space.size
+        def bottom(state):
+            b = bottoms[state]
+            if b < 0:
+                column_states = [state]
+                while fits(state-1):
+                    state -= 1
+                    b = bottoms[state]
+                    if b >= 0:
+                        break
+                    column_states.append(state)
+                else:
+                    b = state
+                for s in column_states:
+                    bottoms[s] = b
+            return b
+
+        budget = self.budget
+        buckets = {}
+        for state in seeds:
+            buckets.setdefault(costs[state], []).append(state)
+
+        inputs = 0
+        while buckets:
+            for state in buckets.pop(inputs, ()):
+                if costs[state] != inputs:
+                    # already expanded with less inputs
+                    continue
+                if budget is not None and self.out_of_budget():
+                    buckets.clear()
+                    break
+                moves = ((state-column, LEFT),
+                         (state+column, RIGHT),
+                         (state-1, DOWN),
+                         (bottom(state), HARD_DROP))
+                # blocks with a single rotation can't rotate
+                if total_rotations > 1:
+                    moves += ((state + rotation if state < last_rotation
+                               else state - last_rotation, ROTATE),)
+
+                for moved, action in moves:
+                    if costs[moved] <= inputs+1:
+                        duplicates += 1
+                        continue
+                    if not fits(moved):
+                        continue
+                    if costs[moved] == UNVISITED:
+                        states.append(moved)
+                    costs[moved] = inputs+1
+                    parents[moved] = state
+                    actions[moved] = action
+                    buckets.setdefault(inputs+1, []).append(moved)
+            inputs += 1
+
+        self.visited_states = len(states)
+        self.duplicate_states = duplicates
+
+        placements = []
+        for state in states:
+            if not fits(state-1):
+                r, x, y = decode(state)
+                placements.append(Placement(
+                    flyweights[r], x, y,
+                    functools.partial(self._get_path, parents, actions, start,
+                                      state)))
+
+        METRICS.counter("search.nodes").inc(len(states))
+        METRICS.counter("search.duplicate_nodes").inc(duplicates)
+        METRICS.average("search.placements").add(len(placements))
+        return placements
+
+    def _get_path(self, parents, actions, start, state):
+        path = []
+        while state != start:
+            path.append(_path_action(actions[state]))
+            state = parents[state]
+        path.reverse()
+        return compact_path(path)
+
+
+class Placement(object):
+    """
+    A final position, `(rotation, x, y)`, of a block together with the
+    path of actions that takes the drop block there.
+
+    `path` can also be a function returning the path, called the first
+    time it's needed.
+    """
+    def __init__(self, block, x, y, path=None):
+        self.block = block
+        self.rotation = block.rotation
+        self.x = x
+        self.y = y
+        self._path = path if path is not None else []
+
+    @property
+    def path(self):
+        if callable(self._path):
+            self._path = self._path()
+        return self._path
 
     def __str__(self):
-        real_pos = self.drop_block.get_real_position(self.drop_position)
-        return "<BoardNode: %s, at %s(real). Previous actions: [%s]>" % \
-           (self.drop_block, real_pos, ", ".join(map(str, self.previous_actions)))
+        return "<Placement: rotation=%d, at (%d, %d). Path: [%s]>" % \
+            (self.rotation, self.x, self.y, ", ".join(map(str, self.path)))
 
     def __eq__(self, o):
-        real_pos = self.drop_block.get_real_position(self.drop_position)
-        o_real_pos = o.drop_block.get_real_position(self.drop_position)
-
-        # the Block class defines it's own __eq__() function
-        return self.drop_block == o.drop_block and \
-                real_pos == o_real_pos
+        return (self.rotation, self.x, self.y) == (o.rotation, o.x, o.y)
 
     def __hash__(self):
-        real_pos = self.drop_block.get_real_position(self.drop_position)
-        return hash((hash(self.drop_block),
-                    hash(real_pos)))
+        return hash((self.rotation, self.x, self.y))
+
+
+class BoardEvaluator(object):
+    """
+    Scores boards with a weighted sum of features, the higher the better.
+
+    Scores are cached by board hash in `self.transposition_table`, which
+    searches using this evaluator can also use for their own results
+    (scores only make sense with the weights they were computed with).
+    """
+    DEFAULT_WEIGHTS = {
+        "aggregate_height": -0.510066,
+        "holes": -0.35663,
+        "bumpiness": -0.184483,
+        "lines": 0.760666,
+    }
+    # order of the weights in parameter vectors, see vector()
+    FEATURES = ("aggregate_height", "holes", "bumpiness", "lines")
+
+    def __init__(self, weights=None, transposition_table=None):
+        self.weights = dict(self.DEFAULT_WEIGHTS)
+        if weights:
+            self.weights.update(weights)
+
+        if transposition_table is None:
+            transposition_table = TranspositionTable()
+        self.transposition_table = transposition_table
+
+    def vector(self):
+        """
+        The weights as a list, in FEATURES order, for optimizers.
+        """
+        return [self.weights[name] for name in self.FEATURES]
+
+    @classmethod
+    def from_vector(cls, vector, transposition_table=None):
+        return cls(dict(zip(cls.FEATURES, vector)), transposition_table)
+
+    def features(self, board, lines=0):
+        return {"aggregate_height": board.aggregate_height,
+                "holes": board.holes,
+                "bumpiness": board.bumpiness,
+                "lines": lines}
+
+    def evaluate(self, board, lines=0):
+        """
+        `lines` is the number of lines done to get to `board`.
+        """
+        return self.evaluate_board(board) + self.weights["lines"] * lines
+
+    def evaluate_board(self, board):
+        """
+        Score of `board` alone, without the lines done to get to it.
+        """
+        key = ("board", board.zobrist_hash)
+        score = self.transposition_table.get(key)
+        if score is None:
+            features = self.features(board)
+            score = sum(w * features[name]
+                        for name, w in self.weights.iteritems()
+                        if name != "lines")
+            self.transposition_table.put(key, score)
+        return score
+
+
+DEFAULT_EVALUATOR = BoardEvaluator()
+
+
+class LookaheadSearchAlgorithm(object):
+    """
+    Beam search over the placements of the drop block and of the next
+    blocks in the game state preview.
+
+    On each level the placements of the next block are tried on the boards
+    of the nodes kept in the beam. Only the `branch_width` best placements
+    of each node (by the evaluation of the board they lead to) become
+    children, and only the `beam_width` best children are kept for the
+    next level, so the cost grows linearly with `depth`.
+
+    Everything is done on one copy of the game state, with
+    GameState.apply_placement() and undo(). The placements of a block on a
+    board, ranked, are kept in the evaluator transposition table, so boards
+    reached again (by other nodes or in later searches) aren't expanded
+    twice.
+
+    With a `budget` (a SearchBudget, counting the boards evaluated) the
+    search stops as soon as it runs out, and the result is the best node
+    of the last level done. A level left halfway is dropped, as it would
+    favour the nodes that were expanded, unless it's the first one.
+    """
+    def __init__(self, game_state, depth=None, beam_width=8,
+                 branch_width=4, evaluator=None, budget=None):
+        self.original_game_state = game_state
+        self.budget = budget
+
+        max_depth = 1 + len(game_state.preview)
+        self.depth = min(depth or max_depth, max_depth)
+        self.beam_width = beam_width
+        self.branch_width = branch_width
+        self.evaluator = evaluator or DEFAULT_EVALUATOR
+
+        self.best_result = None
+
+        # number of boards evaluated by the last search
+        self.evaluated_boards = 0
+        # True if the last search ran out of budget
+        self.budget_exhausted = False
+
+    def go(self):
+        with METRICS.timer("search.time"):
+            self._search()
+
+    @property
+    def optimal_path(self):
+        if self.best_result is None:
+            return []
+        return self.best_result.path
+
+    def _search(self):
+        game_state = self.original_game_state.copy()
+        blocks = [None] + [block_class() for block_class in
+                           game_state.preview[:self.depth-1]]
+        placements_search = PossiblePlacementsAlgorithm(
+            game_state, budget=self.budget, evaluator=self.evaluator)
+        self.evaluated_boards = 0
+
+        beam = [BeamNode([], 0, 0.0)]
+        for level in xrange(self.depth):
+            children = []
+            for node in beam:
+                # the first level is always done, placements_search cuts
+                # it short if needed
+                if level > 0 and \
+                        placements_search.out_of_budget(self.evaluated_boards):
+                    break
+
+                records = self._replay(game_state, node, blocks)
+                if level > 0:
+                    game_state.start_new_drop(blocks[level])
+
+                if not game_state.game_is_over():
+                    children.extend(self._expand(game_state, node,
+                                                 placements_search))
+
+                for record in reversed(records):
+                    game_state.undo(record)
+
+            self.budget_exhausted = placements_search.budget_exhausted
+            if not children or (self.budget_exhausted and level > 0):
+                break
+            children.sort(key=lambda n: n.score, reverse=True)
+            beam = children[:self.beam_width]
+            if self.budget_exhausted:
+                break
+
+        if beam[0].placements:
+            # the placements of the nodes come without paths, only the
+            # one to play needs one, and only if it's asked for
+            first = beam[0].placements[0]
+            beam[0].placements[0] = Placement(
+                first.block, first.x, first.y,
+                functools.partial(self._find_path, game_state, first))
+            self.best_result = beam[0]
+
+    def _find_path(self, game_state, placement):
+        search = PossiblePlacementsAlgorithm(game_state)
+        for p in search.find_placements(game_state):
+            if (p.rotation, p.x, p.y) == \
+                    (placement.rotation, placement.x, placement.y):
+                return p.path
+        return []
+
+    def _replay(self, game_state, node, blocks):
+        records = []
+        for i, placement in enumerate(node.placements):
+            if i > 0:
+                game_state.start_new_drop(blocks[i])
+            records.append(game_state.apply_placement(placement.block,
+                                        (placement.x, placement.y)))
+        return records
+
+    def _expand(self, game_state, node, placements_search):
+        ranked = self._ranked_placements(game_state, placements_search)
+
+        w_lines = self.evaluator.weights["lines"]
+        flyweights = game_state.drop_block.flyweights
+        children = []
+        for rotation, x, y, lines_done, board_score in \
+                ranked[:self.branch_width]:
+            lines = node.lines + lines_done
+            placement = Placement(flyweights[rotation], x, y)
+            children.append(BeamNode(node.placements + [placement], lines,
+                                     board_score + w_lines * lines))
+        return children
+
+    def _ranked_placements(self, game_state, placements_search):
+        """
+        Returns a list of (rotation, x, y, lines done, board score) with
+        every placement of the drop block, the best first.
+
+        The lists are kept in the transposition table, so they're plain
+        tuples: Placement objects would keep the search buffers their
+        paths are built from.
+        """
+        table = self.evaluator.transposition_table
+        key = ("placements", game_state.board.zobrist_hash,
+               game_state.drop_block.key, game_state.drop_position)
+
+        ranked = table.get(key)
+        if ranked is not None:
+            return ranked
+
+        placements = placements_search.find_placements(game_state)
+        with METRICS.timer("search.evaluation_time"):
+            ranked = [(p.rotation, p.x, p.y, lines_done, board_score)
+                      for p, lines_done, board_score in
+                      placements_search.rank(game_state, placements,
+                                             self.evaluated_boards)]
+
+        self.evaluated_boards += len(ranked)
+        # unless some placements are missing
+        if not placements_search.budget_exhausted:
+            table.put(key, ranked)
+        return ranked
+
+
+class BeamNode(object):
+    def __init__(self, placements, lines, score):
+        self.placements = placements
+        self.lines = lines
+        self.score = score
+
+    @property
+    def placement(self):
+        return self.placements[0]
+
+    @property
+    def path(self):
+        return self.placements[0].path
+
+    def __str__(self):
+        return "<BeamNode: score=%f, lines=%d, placements: [%s]>" % \
+            (self.score, self.lines, ", ".join(map(str, self.placements)))
 
 
 class PossibleBlockState(object):
-    def __init__(self, game_state, path):
+    def __init__(self, game_state, path, placement=None):
+        """
+        `path` can be None if `placement` is given, to use its path.
+        """
         self.game_state = game_state
-        self.path = path
+        self._path = path
+        self.placement = placement
 
         self.unconnected_sides = 0
         self.connected_sides = 0
@@ -258,6 +983,12 @@ class PossibleBlockState(object):
 
         self.height = 0
 
+    @property
+    def path(self):
+        if self._path is None:
+            return self.placement.path
+        return self._path
+
     def calc_stats(self):
         directions = (Direction.LEFT, Direction.RIGHT, Direction.UP,
                         Direction.DOWN)
@@ -272,7 +1003,8 @@ class PossibleBlockState(object):
                         adjacent_y):
                     self.connected_sides += 1
                     pass
-                elif self.game_state.board.block_at(adjacent_x, adjacent_y):
+                elif self.game_state.board.square_filled(adjacent_x,
+                                                         adjacent_y):
                     self.connected_sides += 1
                 else:
                     self.unconnected_sides += 1
@@ -314,6 +1046,7 @@ class Action(object):
     def __str__(self):
         a = ["%s=%s" % (k, getattr(self, k)) for k in self.attributes]
         return "<%s, %s>" % (self.__class__.__name__, ", ".join(a))
+    __repr__ = __str__
 
 class MakeMove(Action):
     attributes = ["direction", "times"]
@@ -332,6 +1065,18 @@ class Rotate(Action):
     def __eq__(self, o):
         return self.times == o.times
 
+class HardDrop(Action):
+    """
+    Moves the block straight down as far as it goes, with one input. The
+    block isn't placed until the path ends.
+    """
+    direction = (0, -1)
+    # as many as possible
+    times = None
+
+    def __eq__(self, o):
+        return isinstance(o, HardDrop)
+
 class Direction(object):
     LEFT = (-1, 0)
     RIGHT = (1, 0)
@@ -339,3 +1084,54 @@ class Direction(object):
     DOWN = (0, -1)
 
 
+# actions used while searching, as kept in the action buffers of the
+# searches (see StateSpace)
+LEFT = 1
+RIGHT = 2
+DOWN = 3
+ROTATE = 4
+HARD_DROP = 5
+# action of the state the BFS starts from, see _get_bfs_start_pos()
+START = 6
+
+# number of inputs of the states not reached yet
+UNVISITED = 255
+
+_DIRECTIONS = {LEFT: Direction.LEFT,
+               RIGHT: Direction.RIGHT,
+               DOWN: Direction.DOWN}
+
+
+def _path_action(action):
+    """
+    Returns the Action for one of the search actions.
+    """
+    if action == ROTATE:
+        return Rotate()
+    if action == HARD_DROP:
+        return HardDrop()
+    return MakeMove(_DIRECTIONS[action])
+
+
+def compact_path(actions, stuck=False):
+    """
+    Merges the consecutive moves in the same direction of `actions` into
+    a single MakeMove. If `stuck` is True the path ends where the block
+    can't go further down, so moving down more than once at the end is
+    done with a HardDrop instead.
+    """
+    path = []
+    for action in actions:
+        previous = path[-1] if path else None
+        if isinstance(action, MakeMove) and isinstance(previous, MakeMove) \
+                and previous.direction == action.direction:
+            path[-1] = MakeMove(action.direction, previous.times+action.times)
+        else:
+            path.append(action)
+
+    if stuck and path and isinstance(path[-1], MakeMove) \
+            and path[-1].direction == Direction.DOWN and path[-1].times > 1:
+        path[-1] = HardDrop()
+    return path
+
+
@@ -0,0 +1,220 @@
+"""
+Vectorized evaluation of all the placements of a block at once.
+
+The boards resulting from every placement are stacked in one NumPy array
+of shape (placements, height, width) and every feature is computed for all
+of them with array operations, so the best placement comes out of a single
+argmax instead of one Python evaluation per placement.
+
+NumPy is optional: without it importing this module works, but creating a
+BatchEvaluator raises ImportError.
+"""
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from ai import PossiblePlacementsAlgorithm, BeamNode, BoardEvaluator
+from blocks import BLOCKS
+from metrics import METRICS
+
+# blocks fit in a square of this size and have at most this many
+# rotations, see _shifted_masks()
+MAX_BLOCK_SIZE = 4
+# by board width
+_SHIFTED_MASKS = {}
+
+
+class BatchEvaluator(object):
+    FEATURES = ("aggregate_height", "holes", "bumpiness", "wells",
+                "row_transitions", "column_transitions", "lines")
+
+    # same weights as BoardEvaluator, the extra features are off by default
+    DEFAULT_WEIGHTS = dict(BoardEvaluator.DEFAULT_WEIGHTS,
+                           wells=0.0,
+                           row_transitions=0.0,
+                           column_transitions=0.0)
+
+    def __init__(self, weights=None):
+        if numpy is None:
+            raise ImportError("BatchEvaluator needs numpy")
+
+        self.weights = dict(self.DEFAULT_WEIGHTS)
+        if weights:
+            self.weights.update(weights)
+        self._weights_vector = numpy.array([self.weights[name]
+                                            for name in self.FEATURES])
+
+    def stack_boards(self, game_state, placements):
+        """
+        Places each one of `placements` on the board of `game_state` and
+        returns (boards, lines): a boolean array of shape (placements,
+        height, width) with the resulting boards and an array with the
+        lines done by each placement.
+
+        The board isn't touched: the rows of all the boards are built at
+        once from bitmasks, OR-ing the row masks of each block (see
+        blocks.BlockRotation) shifted to its x, and the completed rows are
+        removed with array operations too.
+        """
+        board = game_state.board
+        n, height = len(placements), board.height
+
+        rows = numpy.tile(numpy.array(_board_rows(board), dtype=numpy.int64),
+                          (n, 1))
+
+        # masks[i, y] is the mask of the row y of the block of placement i,
+        # shifted to its x
+        masks = _shifted_masks(board.width)[
+            [p.block.kind for p in placements],
+            [p.rotation for p in placements],
+            numpy.array([p.x for p in placements]) + MAX_BLOCK_SIZE]
+
+        ys = numpy.array([p.y for p in placements])[:, None] + \
+            numpy.arange(MAX_BLOCK_SIZE)
+        # squares above the top are left out, as place_block() does
+        placed = (masks != 0) & (ys < height)
+        rows[placed.nonzero()[0], ys[placed]] |= masks[placed]
+
+        full = rows == (1 << board.width) - 1
+        lines = full.sum(axis=1)
+        if lines.any():
+            # the rows that stay first, in order, then the empty ones that
+            # come in at the top
+            order = numpy.argsort(full, axis=1, kind="mergesort")
+            rows = rows[numpy.arange(n)[:, None], order]
+            rows[numpy.arange(height) >= height - lines[:, None]] = 0
+
+        bits = numpy.arange(board.width, dtype=numpy.int64)
+        boards = (rows[:, :, None] >> bits) & 1
+        return boards.astype(bool), lines
+
+    def features(self, boards, lines):
+        """
+        Returns an array of shape (boards, len(FEATURES)).
+        """
+        n, height, width = boards.shape
+
+        # height of each column: 1 + y of its highest filled square
+        filled_columns = boards.any(axis=1)
+        top = height - numpy.argmax(boards[:, ::-1, :], axis=1)
+        heights = numpy.where(filled_columns, top, 0)
+
+        # empty squares below the height of their column
+        ys = numpy.arange(height)[None, :, None]
+        holes = ((ys < heights[:, None, :]) & ~boards).sum(axis=(1, 2))
+
+        bumpiness = numpy.abs(numpy.diff(heights, axis=1)).sum(axis=1)
+
+        # depth of each column below both of its neighbours (walls count
+        # as columns as high as the board)
+        walls = numpy.full((n, 1), height, dtype=heights.dtype)
+        padded = numpy.hstack((walls, heights, walls))
+        neighbours = numpy.minimum(padded[:, :-2], padded[:, 2:])
+        wells = numpy.clip(neighbours - heights, 0, None).sum(axis=1)
+
+        # filled/empty changes along each row and each column, the walls
+        # and the floor count as filled
+        side = numpy.ones((n, height, 1), dtype=bool)
+        rows = numpy.concatenate((side, boards, side), axis=2)
+        row_transitions = (rows[:, :, 1:] != rows[:, :, :-1]).sum(axis=(1, 2))
+
+        floor = numpy.ones((n, 1, width), dtype=bool)
+        columns = numpy.concatenate((floor, boards), axis=1)
+        column_transitions = \
+            (columns[:, 1:, :] != columns[:, :-1, :]).sum(axis=(1, 2))
+
+        return numpy.column_stack((heights.sum(axis=1), holes, bumpiness,
+                                   wells, row_transitions, column_transitions,
+                                   lines))
+
+    def scores(self, boards, lines):
+        return self.features(boards, lines).dot(self._weights_vector)
+
+    def best(self, game_state, placements):
+        """
+        Returns (index, score, lines done) of the best of `placements`.
+        """
+        boards, lines = self.stack_boards(game_state, placements)
+        scores = self.scores(boards, lines)
+        i = int(numpy.argmax(scores))
+        return i, float(scores[i]), int(lines[i])
+
+
+def _shifted_masks(width):
+    """
+    Returns an array where [kind, rotation, x + MAX_BLOCK_SIZE, y] is the
+    mask of the row y of the block `kind` (see blocks.BLOCKS) with
+    `rotation` placed at x, for every x from -MAX_BLOCK_SIZE to `width`-1.
+    """
+    shifted = _SHIFTED_MASKS.get(width)
+    if shifted is None:
+        shifted = numpy.zeros((len(BLOCKS), MAX_BLOCK_SIZE,
+                               width + MAX_BLOCK_SIZE, MAX_BLOCK_SIZE),
+                              dtype=numpy.int64)
+        for block_class in BLOCKS:
+            for block in block_class.flyweights:
+                for x in xrange(-MAX_BLOCK_SIZE, width):
+                    for y, mask in block.row_masks:
+                        shifted[block.kind, block.rotation,
+                                x + MAX_BLOCK_SIZE, y] = \
+                            mask << x if x >= 0 else mask >> -x
+        _SHIFTED_MASKS[width] = shifted
+    return shifted
+
+
+def _board_rows(board):
+    if hasattr(board, "rows"):
+        return board.rows
+
+    rows = []
+    for y in xrange(board.height):
+        row = 0
+        for x in xrange(board.width):
+            if board.block_at(x, y):
+                row |= 1 << x
+        rows.append(row)
+    return rows
+
+
+class BatchPlacementsAlgorithm(PossiblePlacementsAlgorithm):
+    """
+    PossiblePlacementsAlgorithm picking the best placement with a
+    BatchEvaluator.
+
+    With a budget, the placements are scored in batches of
+    BUDGET_BATCH_SIZE, the lowest ones first, and the budget is checked
+    after each batch.
+    """
+    BUDGET_BATCH_SIZE = 16
+
+    def __init__(self, game_state, evaluator=None, budget=None):
+        PossiblePlacementsAlgorithm.__init__(self, game_state, budget)
+        self.evaluator = evaluator or BatchEvaluator()
+
+    def _search(self):
+        game_state = self.original_game_state.copy()
+        self.placements = self.find_placements(game_state)
+        if not self.placements:
+            return
+
+        batch_size = len(self.placements)
+        if self.budget is not None:
+            self.placements.sort(key=lambda p: p.y)
+            batch_size = self.BUDGET_BATCH_SIZE
+
+        best = None
+        with METRICS.timer("search.evaluation_time"):
+            for start in xrange(0, len(self.placements), batch_size):
+                end = start + batch_size
+                i, score, lines = self.evaluator.best(
+                    game_state, self.placements[start:end])
+                if best is None or score > best[1]:
+                    best = (start + i, score, lines)
+
+                if self.out_of_budget(end, end < len(self.placements)):
+                    break
+
+        i, score, lines = best
+        self.best_result = BeamNode([self.placements[i]], lines, score)
+        self.optimal_path = self.best_result.path
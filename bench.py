@@ -0,0 +1,327 @@
+#!/usr/bin/python
+"""
+Benchmarks of the board, block and search hot paths.
+
+Every benchmark runs on fixed board fixtures and fixed block sequences, so
+results of different runs are comparable. Results are written as JSON and
+compared against a stored baseline:
+
+    python bench.py --save-baseline          # store the current numbers
+    python bench.py                          # compare against them
+
+The exit status is 1 when some benchmark got slower than the baseline by
+more than the allowed threshold.
+"""
+import sys
+import time
+import json
+import argparse
+
+from log import LOG
+
+from blocks import BLOCKS
+from board import TetrisBoard, BitboardTetrisBoard
+from engine import GameState, HeadlessTetrisEngine
+from pieces import BagPieceGenerator
+from ai import PossiblePlacementsAlgorithm
+import batcheval
+
+DEFAULT_OUTPUT = "bench_results.json"
+DEFAULT_BASELINE = "bench_baseline.json"
+
+# rows from top to bottom, "#" is a filled square
+BOARD_FIXTURES = {
+    "empty": [],
+    "ragged": ["#.........",
+               "##...#...#",
+               "##..###.##",
+               "###.####.#",
+               "#.######.#",
+               "########.#"],
+    "nearly_full": ["....##....",
+                    "#.########",
+                    "####.#####",
+                    "#########.",
+                    "##.#######",
+                    "######.###",
+                    "#######.##",
+                    "###.######",
+                    "#.########",
+                    "########.#",
+                    "####.#####",
+                    "##.#######",
+                    "#######.##",
+                    "#####.####",
+                    "#.########",
+                    "########.#"],
+    "overhangs": ["##....####",
+                  "#.....#..#",
+                  "#..##.#...",
+                  "...##...##",
+                  "####..####",
+                  "#.......##",
+                  "#..####..#",
+                  "#..#..#..#",
+                  "####..####"],
+}
+
+SEQUENCE_SEED = 42
+SEQUENCE_LENGTH = 50
+
+
+def make_board(fixture, board_class=BitboardTetrisBoard):
+    board = board_class()
+    filler = BLOCKS[0]()
+    rows = BOARD_FIXTURES[fixture]
+    for i, row in enumerate(rows):
+        y = len(rows) - i - 1
+        for x, c in enumerate(row):
+            if c == "#":
+                board.fill_square(x, y, filler)
+    return board
+
+
+def make_sequence():
+    generator = BagPieceGenerator(SEQUENCE_SEED)
+    return [generator() for i in xrange(SEQUENCE_LENGTH)]
+
+
+def measure(benchmark, min_time=0.2, repeat=3):
+    """
+    Calls `benchmark` (which does some number of operations and returns
+    that number) until `min_time` seconds pass, `repeat` times, and returns
+    the best rate in operations per second.
+
+    `benchmark` can also be a (setup, func) tuple, in which case `func` is
+    called with what `setup()` returns and only `func` is timed.
+    """
+    if isinstance(benchmark, tuple):
+        setup, func = benchmark
+    else:
+        setup, func = (lambda: None), (lambda _: benchmark())
+
+    best = 0.0
+    for i in xrange(repeat):
+        operations = 0
+        elapsed = 0.0
+        while elapsed < min_time:
+            arg = setup()
+            start_time = time.time()
+            operations += func(arg)
+            elapsed += time.time() - start_time
+        best = max(best, operations / elapsed)
+    return best
+
+
+def bench_block_fits(board):
+    blocks = [b for block_class in BLOCKS for b in block_class.flyweights]
+    positions = [(x, y) for x in xrange(-2, board.width)
+                        for y in xrange(-1, board.height)]
+
+    def run():
+        block_fits = board.block_fits
+        for block in blocks:
+            for pos in positions:
+                block_fits(block, pos)
+        return len(blocks) * len(positions)
+    return run
+
+
+def bench_drop_block_is_stuck(board):
+    game_state = GameState(board)
+    states = [(block, (x, y)) for block_class in BLOCKS
+                              for block in block_class.flyweights
+                              for x in xrange(board.width)
+                              for y in xrange(board.height)
+                              if board.block_fits(block, (x, y))]
+
+    def run():
+        for block, pos in states:
+            game_state.drop_block = block
+            game_state.drop_position = pos
+            game_state.drop_block_is_stuck()
+        return len(states)
+    return run
+
+
+def bench_clear_completed_lines(fixture, board_class):
+    # the fixture with its bottom rows completed, so there is always
+    # something to clear
+    def setup():
+        board = make_board(fixture, board_class)
+        filler = BLOCKS[0]()
+        for y in xrange(4):
+            for x in xrange(board.width):
+                if not board.block_at(x, y):
+                    board.fill_square(x, y, filler)
+        return GameState(board)
+
+    def run(game_state):
+        game_state.clear_completed_lines()
+        return 1
+    return setup, run
+
+
+def bench_rotate():
+    blocks = [block_class() for block_class in BLOCKS]
+
+    def run():
+        for block in blocks:
+            for i in xrange(4):
+                block.rotate()
+        return len(blocks) * 4
+    return run
+
+
+def bench_search(fixture):
+    sequence = make_sequence()
+    game_states = []
+    for block_class in sequence:
+        game_state = GameState(make_board(fixture))
+        game_state.start_new_drop(block_class())
+        if not game_state.game_is_over():
+            game_states.append(game_state)
+
+    def search_all():
+        nodes = 0
+        for game_state in game_states:
+            search = PossiblePlacementsAlgorithm(game_state)
+            search.go()
+            nodes += search.visited_states
+        return len(game_states), nodes
+
+    def run_decisions():
+        return search_all()[0]
+
+    def run_nodes():
+        return search_all()[1]
+
+    return run_decisions, run_nodes
+
+
+def bench_batch_eval(fixture):
+    evaluator = batcheval.BatchEvaluator()
+    searches = []
+    for block_class in make_sequence():
+        game_state = GameState(make_board(fixture))
+        game_state.start_new_drop(block_class())
+        if not game_state.game_is_over():
+            search = PossiblePlacementsAlgorithm(game_state)
+            searches.append((game_state, search.find_placements(game_state)))
+
+    def run():
+        candidates = 0
+        for game_state, placements in searches:
+            evaluator.best(game_state, placements)
+            candidates += len(placements)
+        return candidates
+    return run
+
+
+def bench_game():
+    def run():
+        engine = HeadlessTetrisEngine(SEQUENCE_SEED,
+                                      piece_generator_class=BagPieceGenerator)
+        while engine.running() and engine.placed_blocks < SEQUENCE_LENGTH:
+            search = PossiblePlacementsAlgorithm(engine.game_state)
+            search.go()
+            engine.step(search.best_result.placement)
+        return engine.placed_blocks
+    return run
+
+
+def run_benchmarks(min_time=0.2, repeat=3, only=None):
+    """
+    Returns a dict of benchmark name -> operations per second.
+    """
+    benchmarks = []
+    for fixture in sorted(BOARD_FIXTURES):
+        for board_class in (TetrisBoard, BitboardTetrisBoard):
+            board = make_board(fixture, board_class)
+            suffix = "%s.%s" % (board_class.__name__, fixture)
+            benchmarks.append(("block_fits." + suffix,
+                               bench_block_fits(board)))
+            benchmarks.append(("drop_block_is_stuck." + suffix,
+                               bench_drop_block_is_stuck(board)))
+            benchmarks.append(("clear_completed_lines." + suffix,
+                               bench_clear_completed_lines(fixture,
+                                                           board_class)))
+
+        decisions, nodes = bench_search(fixture)
+        benchmarks.append(("search_decisions." + fixture, decisions))
+        benchmarks.append(("search_nodes." + fixture, nodes))
+
+        if batcheval.numpy is not None:
+            benchmarks.append(("batch_eval_candidates." + fixture,
+                               bench_batch_eval(fixture)))
+
+    benchmarks.append(("rotate", bench_rotate()))
+    benchmarks.append(("game_blocks", bench_game()))
+
+    results = {}
+    for name, func in benchmarks:
+        if only and not any(name.startswith(o) for o in only):
+            continue
+        results[name] = measure(func, min_time, repeat)
+        sys.stderr.write("%-50s %14.1f ops/s\n" % (name, results[name]))
+    return results
+
+
+def compare(results, baseline, threshold):
+    """
+    Returns the list of (name, baseline, result) of the benchmarks that
+    are slower than `baseline` by more than `threshold` (a fraction).
+    """
+    regressions = []
+    for name in sorted(results):
+        if name not in baseline:
+            continue
+        ratio = results[name] / baseline[name]
+        print "%-50s %7.2fx" % (name, ratio)
+        if ratio < 1 - threshold:
+            regressions.append((name, baseline[name], results[name]))
+    return regressions
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("-o", "--output", default=DEFAULT_OUTPUT)
+    parser.add_argument("-b", "--baseline", default=DEFAULT_BASELINE)
+    parser.add_argument("--save-baseline", action="store_true",
+                        help="write the results as the new baseline")
+    parser.add_argument("--threshold", type=float, default=0.2,
+                        help="allowed slowdown before failing (default: 0.2)")
+    parser.add_argument("--min-time", type=float, default=0.2)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("only", nargs="*",
+                        help="only run benchmarks starting with these names")
+    args = parser.parse_args(argv)
+
+    LOG.disable(LOG.DEBUG)
+
+    results = run_benchmarks(args.min_time, args.repeat, args.only)
+
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        return 0
+
+    try:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    except IOError:
+        print "No baseline at %s, run with --save-baseline" % args.baseline
+        return 0
+
+    regressions = compare(results, baseline, args.threshold)
+    for name, old, new in regressions:
+        print "REGRESSION: %s %.1f -> %.1f ops/s" % (name, old, new)
+
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -1,4 +1,5 @@
 import copy
+from collections import namedtuple
 #from PIL import Image, ImageStat
 
 from log import LOG
@@ -78,41 +79,106 @@ class BlockMatrix:
         # cmp(times, 0) -> get the sign of times
         return new_matrix.get_rotated(times + cmp(times,0)*(-1))
 
+class BlockRotation(namedtuple("BlockRotation",
+        "matrix height width solid_squares column_squares row_squares "
+        "top_padding bottom_padding left_padding "
+        "right_padding bounding_box row_masks")):
+    """
+    Immutable lookup table with everything that can be known about one
+    rotation of a block. Built once per rotation, at import time.
+
+    solid_squares  -> (x, y) squares ordered from bottom to top, left to right
+    column_squares -> for each x, its squares from bottom to top
+    row_squares    -> for each y, its squares from left to right
+    bounding_box   -> (left, bottom, right, top), inclusive, in block coords
+    row_masks      -> (y, mask) for each non empty row, from bottom to top,
+                      where `mask` has the bit x set for each solid square
+    """
+
+
+def _build_rotation(matrix):
+    height, width = matrix.m, matrix.n
+
+    solid_squares = tuple((x, y) for y in xrange(height)
+                                 for x in xrange(width)
+                                 if matrix.get_x_y(x, y) == 1)
+    column_squares = tuple(tuple(s for s in solid_squares if s[0] == column)
+                           for column in xrange(width))
+    row_squares = tuple(tuple(s for s in solid_squares if s[1] == row)
+                        for row in xrange(height))
+
+    xs = [x for (x, _) in solid_squares]
+    ys = [y for (_, y) in solid_squares]
+    bounding_box = (min(xs), min(ys), max(xs), max(ys))
+
+    row_masks = tuple((y, sum(1 << x for (x, _) in squares))
+                      for y, squares in enumerate(row_squares) if squares)
+
+    return BlockRotation(matrix=matrix,
+                         height=height,
+                         width=width,
+                         solid_squares=solid_squares,
+                         column_squares=column_squares,
+                         row_squares=row_squares,
+                         top_padding=height - bounding_box[3] - 1,
+                         bottom_padding=bounding_box[1],
+                         left_padding=bounding_box[0],
+                         right_padding=width - bounding_box[2] - 1,
+                         bounding_box=bounding_box,
+                         row_masks=row_masks)
+
+
 class Block:
     total_rotations = 0
 
-    def __init__(self):
-        self.matrix = self.matrixes[0]
-        self.height = self.matrix.m
-        self.width = self.matrix.n
-        self.rotation = 0
+    # filled at import time (see the end of this module):
+    #   kind       -> index of the block class in BLOCKS
+    #   rotations  -> one BlockRotation per rotation
+    #   flyweights -> one shared instance per rotation
+    kind = None
+    rotations = ()
+    flyweights = ()
+
+    def __init__(self, rotation=0):
+        self._set_rotation(rotation)
+
+    def _set_rotation(self, rotation):
+        table = self.rotations[rotation]
+
+        self.rotation = rotation
+        self.table = table
+        self.matrix = table.matrix
+        self.height = table.height
+        self.width = table.width
+
+        self.top_padding = table.top_padding
+        self.bottom_padding = table.bottom_padding
+        self.left_padding = table.left_padding
+        self.right_padding = table.right_padding
 
-        self.top_padding = 0
-        self.bottom_padding = 0
-        self.left_padding = 0
-        self.right_padding = 0
-        self._calc_paddings()
+        self.row_masks = table.row_masks
 
     def __deepcopy__(self, memo):
         # we reimplement deepcopy to make a shallow copy because
         # of the structure of this class.
-        # self.matrixes is made to always point at the same static attributes
+        # all the rotation data points at the same static tables
         # so only reference copies are needed
         return copy.copy(self)
 
     def __hash__(self):
-        # to speed up this hash function I choosed to simply use the
-        # matrix reference and not the matrix by itself
-        # this is ok as long as someone somewhere in the code doesn't
-        # mess up with the static elements of the class
-        # (like assigning self.matrix to a copy of another matrix)
-        return hash((id(self.matrix), self.rotation))
-        #return hash((self.matrix, self.rotation))
+        return hash((self.kind, self.rotation))
 
     def __eq__(self, o):
         return o.__class__ == self.__class__ and \
                 self.rotation == o.rotation
 
+    def __ne__(self, o):
+        return not self == o
+
+    @property
+    def key(self):
+        return (self.kind, self.rotation)
+
     def get_real_position(self, pos):
         return (pos[0] + self.left_padding, pos[1] + self.bottom_padding)
 
@@ -120,9 +186,9 @@ class Block:
         return (pos[0] - self.left_padding, pos[1] - self.bottom_padding)
 
     def column_first_square(self, x):
-        for y in xrange(self.height):
-            if self.matrix.get_x_y(x,y) == 1:
-                return y
+        squares = self.table.column_squares[x]
+        if squares:
+            return squares[0][1]
 
     def __str__(self):
         c = ""
@@ -130,84 +196,37 @@ class Block:
             c = ", color=%s" % paint_block_color(str(self.color), self, True)
         return "<%s, rotation=%d%s>"% (self.__class__, self.rotation, c)
 
-    def _calc_paddings(self):
-        # TODO: this can also be written previously in the code instead
-        # being computed each time this is called
-        self.bottom_padding = 0
-        for y in xrange(self.height):
-            if self.get_solid_squares(y=y):
-                self.bottom_padding = y
-                break
-
-        self.top_padding = 0
-        for y in reversed(xrange(self.height)):
-            if self.get_solid_squares(y=y):
-                self.top_padding = self.height-y-1
-                break
-
-        self.left_padding = 0
-        for x in xrange(self.width):
-            if self.get_solid_squares(x=x):
-                self.left_padding = x
-                break
-
-        self.right_padding = 0
-        for x in reversed(xrange(self.width)):
-            if self.get_solid_squares(x=x):
-                self.right_padding = self.width-x-1
-                break
-
     def rotate(self, times=1):
-        # the % operation has no problems with negative `times`
-        self.rotation = (self.rotation+times) % self.total_rotations
+        """
+        Rotates this block in place.
 
-        # old way of rotating blocks:
-        # compute the rotated matrix each time this is called
-        #self.matrix = self.matrix.get_rotated(times)
-        self.matrix = self.matrixes[self.rotation]
-        self.height = self.matrix.m
-        self.width = self.matrix.n
-        self._calc_paddings()
+        Never call this on one of the shared `flyweights` (like the ones
+        returned by get_rotated()), use get_rotated() instead.
+        """
+        # the % operation has no problems with negative `times`
+        self._set_rotation((self.rotation+times) % self.total_rotations)
 
     def get_rotated(self, times=1):
-        new_block = copy.deepcopy(self)
-        new_block.rotate(times)
-        return new_block
+        """
+        Returns the shared instance of this block rotated `times` times.
+        """
+        return self.flyweights[(self.rotation+times) % self.total_rotations]
 
     # no used
     def _get_all_rotations(self):
-        yield copy.deepcopy(self)
-        for i in xrange(self.total_rotations-1):
-            new_block = copy.deepcopy(self)
-            new_block.rotate()
-            yield new_block
-
+        return self.flyweights
 
-    # TODO: this doesn't need to be running all the time!!
-    # save the results in a static way like what was done with the rotations
     def get_solid_squares(self, x=None, y=None):
         """
         Results are ordered by crescent order.
         If x-> squares come from bottom to top
         If y-> squares como from left to right
         """
-        squares = []
         if x is not None:
-            for y in xrange(self.height):
-                if self.matrix.get_x_y(x,y) == 1:
-                    squares.append((x,y))
+            return self.table.column_squares[x]
         elif y is not None:
-            for x in xrange(self.width):
-                if self.matrix.get_x_y(x,y) == 1:
-                    squares.append((x,y))
-
-        else:
-            for y in xrange(self.height):
-                for x in xrange(self.width):
-                    if self.matrix.get_x_y(x,y) == 1:
-                        squares.append((x,y))
-
-        return squares
+            return self.table.row_squares[y]
+        return self.table.solid_squares
 
 
 class BlockCube(Block):
@@ -332,3 +351,10 @@ class BlockLine(Block):
 
 BLOCKS = (BlockCube, BlockLeftEnv, BlockRightEnv, BlockLeftL,
           BlockRightL, BlockSuper, BlockLine)
+
+
+for kind, block_class in enumerate(BLOCKS):
+    block_class.kind = kind
+    block_class.rotations = tuple(map(_build_rotation, block_class.matrixes))
+    block_class.flyweights = tuple(block_class(rotation)
+                                   for rotation in xrange(block_class.total_rotations))
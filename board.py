@@ -1,16 +1,51 @@
 import rpdb2
+import copy
+import random
 
 from log import LOG
+from tracing import get_tracer
+
+TRACE = get_tracer("board")
 
 class TetrisBoard:
+    """
+    Besides the squares, the board keeps these metrics up to date on every
+    change, so they can be read in O(1):
+
+        row_fill         -> number of filled squares of each row
+        _column_heights  -> 1 + y of the highest filled square of each
+                            column (see column_height())
+        column_holes     -> empty squares below the height of each column
+        column_covered   -> filled squares above the lowest hole of each
+                            column
+        surface_profile  -> height difference between each column and the
+                            next one
+        holes, covered, aggregate_height, bumpiness
+                         -> totals of the above (bumpiness is the sum of
+                            the height differences of adjacent columns)
+    """
     def __init__(self, height=20, width=10):
         self.height = height
         self.width = width
         self.board = []
 
+        self._start_new_board()
+
+        self.row_fill = [0] * self.height
         self._column_heights = [0] * self.width
+        self.column_holes = [0] * self.width
+        self.column_covered = [0] * self.width
+        self.surface_profile = [0] * (self.width-1)
+        self.holes = 0
+        self.covered = 0
+        self.aggregate_height = 0
+        self.bumpiness = 0
 
-        self._start_new_board()
+        # Zobrist hash of the filled squares, kept up to date by every
+        # method that changes the board. Equal boards have equal hashes.
+        self._zobrist_keys = _zobrist_keys(self.width, self.height)
+        self._row_hashes = [0] * self.height
+        self.zobrist_hash = 0
 
     def _start_new_board(self):
         self.board = []
@@ -27,6 +62,13 @@ class TetrisBoard:
 
         return self.board[y][x]
 
+    def square_filled(self, x, y):
+        """
+        True if the square (x, y) is filled, like block_at() but without
+        looking at the block that fills it. Squares above the top are empty.
+        """
+        return y < self.height and bool(self._square_filled(x, y))
+
     def block_fits(self, block, pos, ignore_top=True):
         solid_squares = block.get_solid_squares()
         blocks_outside_top = 0
@@ -54,13 +96,89 @@ class TetrisBoard:
 
         return True
 
+    def copy(self):
+        """
+        Returns an independent copy of this board. Blocks are shared.
+        """
+        new_board = copy.copy(self)
+        self._copy_squares(new_board)
+
+        new_board.row_fill = list(self.row_fill)
+        new_board._column_heights = list(self._column_heights)
+        new_board.column_holes = list(self.column_holes)
+        new_board.column_covered = list(self.column_covered)
+        new_board.surface_profile = list(self.surface_profile)
+        new_board._row_hashes = list(self._row_hashes)
+        return new_board
+
+    def line_is_complete(self, y):
+        return self.row_fill[y] == self.width
+
     def clear_line(self, y_line):
-        for y in range(y_line, self.height-1):
-            self.board[y] = self.board[y+1]
-        self.board[self.height-1] = [None,]*self.width
+        """
+        Removes the line `y_line`, moving every line above it down.
+
+        Returns the removed line, to be given back to restore_line().
+        """
+        return self.clear_lines([y_line])[0][1]
+
+    def restore_line(self, y_line, line):
+        """
+        Undoes clear_line(): moves every line from `y_line` up, dropping the
+        (empty) top line, and puts `line` back at `y_line`.
+        """
+        self.restore_lines([(y_line, line)])
+
+    def clear_lines(self, y_lines):
+        """
+        Removes all the (completed) lines in `y_lines` at once, moving the
+        remaining lines down in a single pass.
+
+        Returns a list of (y, line) with the removed lines from bottom to
+        top, to be given back to restore_lines().
+        """
+        y_lines = sorted(set(y_lines))
+        if not y_lines:
+            return []
+
+        lines = self._remove_lines(y_lines)
+
+        removed = set(y_lines)
+        self.row_fill = [fill for y, fill in enumerate(self.row_fill)
+                         if y not in removed] + [0] * len(y_lines)
+
+        top_line = y_lines[-1]
+        for x in xrange(self.width):
+            if self.column_holes[x] or \
+                    self._column_heights[x] <= top_line+1:
+                # the holes below the lines may be uncovered now
+                self._update_column(x)
+            else:
+                self._set_column(x, self._column_heights[x]-len(y_lines),
+                                 0, 0)
+
+        self._rehash_rows(y_lines[0])
+
+        return zip(y_lines, lines)
+
+    def restore_lines(self, cleared):
+        """
+        Undoes clear_lines(), `cleared` being what it returned.
+        """
+        if not cleared:
+            return
+
+        self._insert_lines(cleared)
+
+        for y, _ in cleared:
+            self.row_fill.pop()
+            self.row_fill.insert(y, sum(self._square_filled(x, y)
+                                        for x in xrange(self.width)))
 
         for x in xrange(self.width):
-            self._column_heights[x] -= 1
+            self._update_column(x)
+
+        self._rehash_rows(cleared[0][0])
 
     def column_height(self, x_column):
         assert x_column >= 0 and x_column < self.width, "Hmmm %d" % x_column
@@ -70,12 +188,13 @@ class TetrisBoard:
         """
         Updates the board by placing `block` at the position `pos`.
         """
-        LOG.debug("Placing %s at %s" % (block, pos))
+        # searches place blocks all the time
+        TRACE.sampled("Placing %s at %s", block, pos)
 
-        solid_squares = block.get_solid_squares()
-        heighest_columns = [0] * self.width
+        # x -> [lowest y, highest y, number of squares]
+        columns = {}
 
-        for (x,y) in solid_squares:
+        for (x,y) in block.get_solid_squares():
             final_x, final_y = pos[0]+x, pos[1]+y
 
             if ignore_top and final_y >= self.height:
@@ -84,22 +203,299 @@ class TetrisBoard:
             assert self.valid_position(final_x, final_y, ignore_top), \
                 "Trying to place %s outside the board limits! (%s)" % (block, pos)
 
-            if self.board[final_y][final_x] != None:
+            if self._square_filled(final_x, final_y):
                 LOG.critical("Writing on (%d,%d), a position of the" % (final_x, final_y) + \
                         "board already filled, something wrong happend!")
 
-            self.board[final_y][final_x] = block
+            self._set_square(final_x, final_y, block)
+            self._toggle_square_hash(final_x, final_y)
+            self.row_fill[final_y] += 1
+
+            column = columns.get(final_x)
+            if column is None:
+                columns[final_x] = [final_y, final_y, 1]
+            else:
+                column[0] = min(column[0], final_y)
+                column[1] = max(column[1], final_y)
+                column[2] += 1
+
+        for x, (lowest, highest, count) in columns.iteritems():
+            if lowest == self._column_heights[x] and \
+                    highest - lowest + 1 == count:
+                # stacked right on top of the column, no new holes
+                covered = self.column_covered[x]
+                if self.column_holes[x]:
+                    covered += count
+                self._set_column(x, highest+1, self.column_holes[x], covered)
+            else:
+                self._update_column(x)
+
+    def remove_block(self, block, pos, ignore_top=True):
+        """
+        Undoes place_block(): empties the squares of `block` at `pos`.
+        """
+        columns = set()
+        for (x,y) in block.get_solid_squares():
+            final_x, final_y = pos[0]+x, pos[1]+y
+
+            if ignore_top and final_y >= self.height:
+                continue
+
+            self._set_square(final_x, final_y, None)
+            self._toggle_square_hash(final_x, final_y)
+            self.row_fill[final_y] -= 1
+            columns.add(final_x)
+
+        for x in columns:
+            self._update_column(x)
+
+    def fill_square(self, x, y, block):
+        """
+        Fills the single square (x, y) with `block`, e.g. to set up a board
+        for tests or benchmarks.
+        """
+        assert not self._square_filled(x, y), "(%d, %d) already filled" % (x, y)
+
+        self._set_square(x, y, block)
+        self._toggle_square_hash(x, y)
+        self.row_fill[y] += 1
+        self._update_column(x)
+
+    def _update_column(self, x):
+        """
+        Recomputes the metrics of the column `x` from its squares.
+        """
+        height = holes = covered = filled = 0
+        for y in reversed(xrange(self.height)):
+            if self._square_filled(x, y):
+                if not height:
+                    height = y + 1
+                filled += 1
+            elif height:
+                holes += 1
+                covered = filled
+
+        self._set_column(x, height, holes, covered)
+
+    def _set_column(self, x, height, holes, covered):
+        heights = self._column_heights
+        old_height = heights[x]
+
+        if x > 0:
+            self.bumpiness += abs(heights[x-1] - height) - \
+                              abs(heights[x-1] - old_height)
+            self.surface_profile[x-1] = height - heights[x-1]
+        if x < self.width-1:
+            self.bumpiness += abs(heights[x+1] - height) - \
+                              abs(heights[x+1] - old_height)
+            self.surface_profile[x] = heights[x+1] - height
+
+        self.aggregate_height += height - old_height
+        self.holes += holes - self.column_holes[x]
+        self.covered += covered - self.column_covered[x]
 
-            if final_y >= heighest_columns[final_x]:
-                heighest_columns[final_x] = final_y + 1
+        heights[x] = height
+        self.column_holes[x] = holes
+        self.column_covered[x] = covered
 
-        for (x, _) in solid_squares:
-            final_x = pos[0]+x
+    # the methods below are the only ones that access the squares storage
 
-            if heighest_columns[final_x] > self._column_heights[final_x]:
-                self._column_heights[final_x] = heighest_columns[final_x]
+    def _square_filled(self, x, y):
+        return self.board[y][x] is not None
+
+    def _set_square(self, x, y, block):
+        self.board[y][x] = block
+
+    def _copy_squares(self, new_board):
+        new_board.board = [list(row) for row in self.board]
+
+    def _remove_lines(self, y_lines):
+        """
+        Removes the lines `y_lines` (sorted), adding empty lines at the top,
+        and returns them.
+        """
+        self.board, lines = _compact(self.board, y_lines)
+        for line in lines:
+            self.board.append([None,]*self.width)
+        return lines
+
+    def _insert_lines(self, lines):
+        """
+        Inserts back the (y, line), sorted by y, removed by _remove_lines(),
+        dropping the (empty) lines at the top.
+        """
+        del self.board[self.height-len(lines):]
+        for y, line in lines:
+            self.board.insert(y, line)
+
+    def _toggle_square_hash(self, x, y):
+        key = self._zobrist_keys[y][x]
+        self._row_hashes[y] ^= key
+        self.zobrist_hash ^= key
+
+    def _rehash_rows(self, y_from):
+        """
+        Recomputes the hashes of the rows from `y_from` up, after they have
+        been moved.
+        """
+        for y in xrange(y_from, self.height):
+            row_hash = self._row_hash(y)
+            self.zobrist_hash ^= self._row_hashes[y] ^ row_hash
+            self._row_hashes[y] = row_hash
+
+    def _row_hash(self, y):
+        keys = self._zobrist_keys[y]
+        row_hash = 0
+        for x in xrange(self.width):
+            if self._square_filled(x, y):
+                row_hash ^= keys[x]
+        return row_hash
 
     def valid_position(self, x, y, ignore_top=True):
         return x >= 0 and x < self.width and \
                y >= 0 and (ignore_top or y < self.height)# and \
                #self.block_at(x, y) is None
+
+
+class BitboardTetrisBoard(TetrisBoard):
+    """
+    Same API as TetrisBoard, but each row is stored as an integer bitmask
+    (bit x set means the square (x, y) is filled) and collisions are checked
+    by ANDing the rows with the block's row masks.
+
+    The placed blocks themselves (needed only for their colors) are kept in
+    a separate side table, `self.colors`, which only the renderer reads
+    through block_at(). Its rows are shared with copies of the board and
+    copied on write.
+    """
+    def __init__(self, height=20, width=10):
+        self.rows = []
+        self.colors = []
+        self.full_row = (1 << width) - 1
+
+        TetrisBoard.__init__(self, height, width)
+
+    def _start_new_board(self):
+        self.rows = [0] * self.height
+        self.colors = []
+        for i in xrange(self.height):
+            self.colors.append( [None,]*self.width )
+
+    def block_at(self, x, y, ignore_top=True):
+        assert x >= 0 and x < self.width and y >= 0 and \
+                (ignore_top or y < self.height), \
+                "(%d, %d) coordinates go beyond the board size" % (x, y)
+
+        if ignore_top and y >= self.height:
+            return None
+
+        if not self.rows[y] >> x & 1:
+            return None
+        return self.colors[y][x]
+
+    def block_fits(self, block, pos, ignore_top=True):
+        x_pos, y_pos = pos
+
+        if x_pos + block.left_padding < 0 or \
+                x_pos + block.width - block.right_padding > self.width or \
+                y_pos + block.bottom_padding < 0:
+            return False
+
+        if y_pos + block.bottom_padding >= self.height:
+            # every square would be above the top of the board
+            return False
+
+        if not ignore_top and \
+                y_pos + block.height - block.top_padding > self.height:
+            return False
+
+        rows = self.rows
+        for y_block, mask in block.row_masks:
+            y = y_pos + y_block
+            if y >= self.height:
+                break
+            if x_pos >= 0:
+                mask <<= x_pos
+            else:
+                mask >>= -x_pos
+            if rows[y] & mask:
+                return False
+
+        return True
+
+    def _square_filled(self, x, y):
+        return self.rows[y] >> x & 1
+
+    def _set_square(self, x, y, block):
+        if block is None:
+            self.rows[y] &= ~(1 << x)
+        else:
+            self.rows[y] |= 1 << x
+
+        # color rows can be shared with copies of this board
+        row = list(self.colors[y])
+        row[x] = block
+        self.colors[y] = row
+
+    def _copy_squares(self, new_board):
+        new_board.rows = list(self.rows)
+        new_board.colors = list(self.colors)
+
+    def _remove_lines(self, y_lines):
+        self.rows, rows = _compact(self.rows, y_lines)
+        self.colors, colors = _compact(self.colors, y_lines)
+        for y in y_lines:
+            self.rows.append(0)
+            self.colors.append([None,]*self.width)
+        return zip(rows, colors)
+
+    def _insert_lines(self, lines):
+        del self.rows[self.height-len(lines):]
+        del self.colors[self.height-len(lines):]
+        for y, (row, colors) in lines:
+            self.rows.insert(y, row)
+            self.colors.insert(y, colors)
+
+    def _row_hash(self, y):
+        keys = self._zobrist_keys[y]
+        row = self.rows[y]
+        row_hash = 0
+        x = 0
+        while row:
+            if row & 1:
+                row_hash ^= keys[x]
+            row >>= 1
+            x += 1
+        return row_hash
+
+
+def _compact(lines, y_lines):
+    """
+    Splits `lines` in one pass into (the lines not in `y_lines`, the lines
+    in `y_lines`), both in the same order as in `lines`. `y_lines` must be
+    sorted.
+    """
+    kept = []
+    removed = []
+    start = 0
+    for y in y_lines:
+        kept.extend(lines[start:y])
+        removed.append(lines[y])
+        start = y + 1
+    kept.extend(lines[start:])
+    return kept, removed
+
+
+ZOBRIST_SEED = 0x7e7215
+
+# (width, height) -> keys[y][x], one random 64 bits key per square
+_ZOBRIST_KEYS = {}
+
+def _zobrist_keys(width, height):
+    keys = _ZOBRIST_KEYS.get((width, height))
+    if keys is None:
+        rng = random.Random(ZOBRIST_SEED)
+        keys = tuple(tuple(rng.getrandbits(64) for x in xrange(width))
+                     for y in xrange(height))
+        _ZOBRIST_KEYS[(width, height)] = keys
+    return keys
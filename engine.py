@@ -2,144 +2,493 @@ import rpdb2
 import threading
 import time
 import random
+import copy
 
 from log import LOG
 from blocks import BLOCKS, paint_block_color
+from board import BitboardTetrisBoard
+from pieces import UniformPieceGenerator
+from render import RenderThread
+from gravity import Waker, gravity_interval
+from metrics import METRICS
+from tracing import get_tracer
+
+TRACE = get_tracer("engine")
+GAME_TRACE = get_tracer("game")
 
 DROPPING_TIMEOUT = 60
 
 def updateGame(f):
-    def func(engine):
+    """
+    Runs an engine action with the game lock held, and records it.
+
+    If the action is called with an `expected` keyword argument, a
+    GameState.drop_state() value, it's only done if the game is still in
+    that state when the lock is taken. Otherwise nothing happens and None
+    is returned.
+    """
+    def func(engine, *args, **kwargs):
+        expected = kwargs.pop("expected", None)
         if not engine.running():
             LOG.error("Engine not running! Not executing action")
             return 0
-        engine._update_game_lock.acquire()
-        done_lines = f(engine)
+        a = time.time()
+        with engine._update_game_lock:
+            METRICS.histogram("engine.lock_wait").add(time.time()-a)
+            if expected is not None and \
+                    engine.game_state.drop_state() != expected:
+                TRACE.debug("%s for a stale state, ignored", f.__name__)
+                return None
+            done_lines = f(engine, *args, **kwargs)
+            if engine.recorder is not None:
+                engine.recorder.action(f.__name__, args)
         engine.print_game()
-        engine._update_game_lock.release()
         return done_lines
     return func
 
 
 class TetrisEngine(object):
-    def __init__(self, game_state):
+    def __init__(self, game_state, max_fps=30, level=None, recorder=None):
+        """
+        The game is drawn by its own thread, at most `max_fps` times per
+        second (None for no limit), and only when it changes.
+
+        The drop block falls one line every DROPPING_TIMEOUT seconds or, if
+        `level` is given, at the speed of that gravity level.
+
+        If a `recorder` (a recording.GameRecorder) is given, the game is
+        recorded with it.
+        """
         self.game_state = game_state
+        self.recorder = recorder
         self._thread = threading.Thread(target=self._run_thread,
                                         name="engineThread")
 
         self._exiting = False
         self._running = False
         self._restart_timeout = False
+        self._started = threading.Event()
+
+        # wakes the engine thread up before the drop deadline
+        self._waker = Waker()
+        # woken up once, when the engine stops
+        self._stopped = Waker()
+        self.drop_timeout = DROPPING_TIMEOUT
+        # time of the next gravity tick
+        self.drop_deadline = None
+        if level is not None:
+            self.drop_timeout = gravity_interval(level)
 
         self._update_game_lock = threading.RLock()
 
+        self._render_thread = RenderThread(self.snapshot, max_fps=max_fps)
+
     def start(self):
+        """
+        Starts the engine and returns once it's running.
+        """
+        self._render_thread.start()
         self._thread.start()
-        while not self.running():
-            time.sleep(0.1)
+        self._started.wait()
 
     def _run_thread(self):
         LOG.debug("Started game engine thread")
         self._running = True
 
         try:
+            if self.recorder is not None:
+                self.recorder.start_game(self.game_state)
             self.game_state.start_new_drop()
             self.print_game()
+            self._started.set()
 
-            while not self._exiting:
-                a = time.time()
-                while time.time()-a < DROPPING_TIMEOUT \
-                        and not self._exiting and not self._restart_timeout \
-                        and not self.game_state.game_is_over():
-                    time.sleep(0.1)
+            self.drop_deadline = time.time() + self.drop_timeout
+            while not self._exiting and not self.game_state.game_is_over():
+                self._waker.wait(max(self.drop_deadline - time.time(), 0))
 
-                if not self._exiting and not self._restart_timeout \
-                    and not self.game_state.game_is_over():
-                    self._drop_timeout_update()
-
-                if self.game_state.game_is_over():
-                    self._exiting = True
+                if self._exiting or self.game_state.game_is_over():
+                    break
 
-                self._restart_timeout = False
+                if self._restart_timeout:
+                    self._restart_timeout = False
+                    self.drop_deadline = time.time() + self.drop_timeout
+                elif time.time() >= self.drop_deadline:
+                    self._drop_timeout_update()
+                    self._restart_timeout = False
+                    self.drop_deadline = time.time() + self.drop_timeout
 
             LOG.debug("Engine thread terminated")
 
         except Exception:
             LOG.debug("Engine thread just crashed!", exc_info=True)
 
+        # draws the last frame
+        self._render_thread.stop()
         self._running = False
 
+        if self.recorder is not None:
+            with self._update_game_lock:
+                self.recorder.end_game(self.game_state)
+        self._started.set()
+        self._stopped.wake()
+        self._waker.close()
+
     def stop(self):
         LOG.debug("Stopping engine")
         self._exiting = True
-        while self.running():
-            time.sleep(0.1)
+        self._waker.wake()
+        if self._thread.is_alive():
+            self._thread.join()
+        self._stopped.close()
+
+    def fileno(self):
+        """
+        A file descriptor that becomes readable when the engine stops, so
+        the engine can be select()ed along with the input, until stop()
+        closes it.
+        """
+        return self._stopped.fileno()
+
+    def wait(self):
+        """
+        Blocks until the engine stops.
+        """
+        self._thread.join()
+
+    def set_level(self, level):
+        """
+        Changes the gravity to the speed of `level`, from now on.
+        """
+        self.drop_timeout = gravity_interval(level)
+        self._restart_gravity()
+
+    def _restart_gravity(self):
+        self._restart_timeout = True
+        self._waker.wake()
 
     def running(self):
         return self._running
 
+    def time_to_drop(self):
+        """
+        Seconds left before gravity moves the drop block down.
+        """
+        if self.drop_deadline is None:
+            return self.drop_timeout
+        return max(self.drop_deadline - time.time(), 0)
+
     def print_game(self):
-        print "\033[H\033[J"
-        s = self.game_state.board_print()
-        print s
+        """
+        Asks the render thread to draw the game, without waiting for it.
+        """
+        self._render_thread.notify()
+
+    def snapshot(self):
+        """
+        Returns a copy of the game state, taken with the game lock held.
+        """
+        with self._update_game_lock:
+            return self.game_state.copy()
 
     @updateGame
     def _drop_timeout_update(self):
-        LOG.debug("ENGINE - drop timeout update")
+        TRACE.debug("Drop timeout update")
         return self.move_down()
 
     @updateGame
     def move_down(self):
-        LOG.debug("ENGINE - move down")
-        self._restart_timeout = True
-        if self.game_state.drop_block_is_stuck():
-            done_lines = self.game_state.move_block_down()
-            self.game_state.start_new_drop()
-            return done_lines
+        TRACE.debug("Move down")
+        return self._move_down()
 
-        self.game_state.move_block_down()
-        return 0
+    def _move_down(self):
+        self._restart_gravity()
+        return self.game_state.step_down()
 
     @updateGame
     def drop_block(self):
-        LOG.debug("ENGINE - drop block")
-        LOG.debug("Dropping block: %s" % self.game_state)
-
-        self._restart_timeout = True
+        TRACE.debug("Drop block")
+        TRACE.debug("Dropping %s from %s", self.game_state.drop_block,
+                    self.game_state.drop_position)
 
-        while not self.game_state.drop_block_is_stuck():
-            LOG.debug("looping while not drop block is stuck")
-            self.game_state.move_block_down()
+        self._restart_gravity()
+        return self.game_state.hard_drop()
 
-        done_lines = self.game_state.move_block_down()
-        self.game_state.start_new_drop()
-
-        return done_lines
+    @updateGame
+    def execute(self, path, latency=None):
+        """
+        Plays a whole path at once: `path` is a list of actions (ai.MakeMove,
+        ai.HardDrop and ai.Rotate) or anything with a `path` attribute, like
+        ai.Placement. The drop block follows it and then moves down once
+        more, which places it at the end of a complete path.
+
+        Everything happens with the lock taken once and a single frame
+        drawn. The path is checked before anything changes: if some action
+        can't be done the game is left as it was and None is returned,
+        otherwise the number of lines done.
+
+        `latency` is the time it took to decide the path, for the recording.
+
+        Pass the drop state the path was searched from as `expected` to
+        play it only if gravity didn't change it in the meantime (see
+        updateGame()).
+        """
+        path = getattr(path, "path", path)
+        TRACE.debug("Execute %s", path)
+
+        with METRICS.timer("engine.execute_time"):
+            done_lines = self.game_state.play_path(path)
+            if done_lines is None:
+                TRACE.info("Path can't be followed by %s from %s",
+                           self.game_state.drop_block,
+                           self.game_state.drop_position)
+                return None
+
+            self._restart_gravity()
+            return done_lines
 
     @updateGame
     def move_left(self):
-        LOG.debug("ENGINE - move left")
+        TRACE.debug("Move left")
         return self.game_state.move_block_left()
 
     @updateGame
     def move_right(self):
-        LOG.debug("ENGINE - move right")
+        TRACE.debug("Move right")
         return self.game_state.move_block_right()
 
     @updateGame
     def rotate(self):
-        LOG.debug("ENGINE - rotate")
+        TRACE.debug("Rotate")
         self.game_state.rotate_block()
 
     def set_game_state(self, state):
-        self._update_game_lock.acquire()
-        self.game_state = state
-        self._update_game_lock.release()
+        with self._update_game_lock:
+            self.game_state = state
+        self.print_game()
+
+
+class AsyncTetrisEngine(TetrisEngine):
+    """
+    TetrisEngine run by an eventloop.EventLoop instead of its own threads:
+    gravity is a timer of the loop and drawing is a callback, so one loop
+    can run many games at once.
+
+    All its methods must be called from the loop.
+    """
+    def __init__(self, game_state, loop, level=None, renderer=None,
+                 max_fps=30, on_stop=None, recorder=None):
+        """
+        The game is drawn with `renderer` (a render.TerminalRenderer, or
+        None to not draw it at all) at most `max_fps` times per second.
+        `on_stop` is called with no arguments when the engine stops.
+        """
+        # no TetrisEngine.__init__(): there are no threads nor pipes here
+        self.game_state = game_state
+        self.recorder = recorder
+        self.loop = loop
+        self.renderer = renderer
+        self.max_fps = max_fps
+        self.on_stop = on_stop
+
+        self._running = False
+        self._restart_timeout = False
+        self.drop_timeout = DROPPING_TIMEOUT
+        if level is not None:
+            self.drop_timeout = gravity_interval(level)
+
+        # only the loop takes it, so it's never contended
+        self._update_game_lock = threading.RLock()
+
+        self.drop_deadline = None
+        self._gravity_handle = None
+        self._frame_handle = None
+        self._last_frame_time = 0
+
+    def start(self):
+        LOG.debug("Starting async game engine")
+        self._running = True
+        if self.recorder is not None:
+            self.recorder.start_game(self.game_state)
+        self.game_state.start_new_drop()
+        self._restart_gravity()
+        self.print_game()
+
+    def stop(self):
+        if not self._running:
+            return
+
+        LOG.debug("Stopping async engine")
+        self._running = False
+        if self._gravity_handle is not None:
+            self._gravity_handle.cancel()
+        if self._frame_handle is not None:
+            self._frame_handle.cancel()
+        self._draw_frame()
+
+        if self.recorder is not None:
+            self.recorder.end_game(self.game_state)
+
+        if self.on_stop:
+            self.on_stop()
+
+    def _restart_gravity(self):
+        if self._gravity_handle is not None:
+            self._gravity_handle.cancel()
+        self.drop_deadline = self.loop.time() + self.drop_timeout
+        self._gravity_handle = self.loop.call_at(self.drop_deadline,
+                                                 self._drop_timeout_update)
+
+    def print_game(self):
+        """
+        Schedules a frame, if there isn't one already. This is also where
+        the engine notices the game is over.
+        """
+        if self._frame_handle is not None:
+            return
+
+        delay = 0
+        if self.renderer and self.max_fps:
+            delay = max(self._last_frame_time + 1.0/self.max_fps
+                        - self.loop.time(), 0)
+        self._frame_handle = self.loop.call_later(delay, self._frame)
+
+    def _frame(self):
+        self._frame_handle = None
+        if self.game_state.game_is_over():
+            self.stop()
+        else:
+            self._draw_frame()
+
+    def _draw_frame(self):
+        if self.renderer:
+            self.renderer.render(self.game_state)
+            self._last_frame_time = self.loop.time()
+
+
+class HeadlessTetrisEngine(object):
+    """
+    Synchronous engine, with no threads, locks, timers nor rendering, to
+    simulate games at full CPU speed.
+
+    There is no gravity: each step() places the drop block at its final
+    position and starts the next drop, following the GameState rules.
+    """
+    def __init__(self, seed=None, board_class=BitboardTetrisBoard,
+                 piece_generator_class=UniformPieceGenerator, preview_size=0,
+                 recorder=None):
+        """
+        If a `recorder` (a recording.GameRecorder) is given, every game is
+        recorded with it.
+        """
+        self.board_class = board_class
+        self.piece_generator_class = piece_generator_class
+        self.preview_size = preview_size
+        self.game_state = None
+        self.placed_blocks = 0
+        self.recorder = recorder
+
+        self.reset(seed)
+
+    def reset(self, seed=None):
+        """
+        Starts a new game. The same `seed` always gives the same sequence
+        of blocks.
+        """
+        if self.game_state is not None:
+            self.finish()
+
+        self.game_state = GameState(self.board_class(),
+                                    self.piece_generator_class(seed),
+                                    self.preview_size)
+        self.placed_blocks = 0
+        if self.recorder is not None:
+            self.recorder.start_game(self.game_state, seed)
+        self.game_state.start_new_drop()
+
+    def running(self):
+        return not self.game_state.game_is_over()
+
+    def finish(self):
+        """
+        Ends the recording of the current game, if it's being recorded.
+        Games that end with a game over are finished by step().
+        """
+        if self.recorder is not None:
+            self.recorder.end_game(self.game_state)
+
+    def step(self, placement, latency=None):
+        """
+        Places the drop block with the rotation and at the position given
+        by `placement` (anything with `rotation`, `x` and `y` attributes,
+        like ai.Placement) and starts the next drop.
+
+        `placement` must be a final position, i.e. the block must fit there
+        and be stuck. Reachability from the drop position isn't checked.
+
+        `latency` is the time it took to decide the placement, for the
+        recording.
+
+        Returns the number of lines done.
+        """
+        game_state = self.game_state
+        assert not game_state.game_is_over(), "Game is over"
+
+        block = game_state.drop_block.flyweights[placement.rotation]
+        position = (placement.x, placement.y)
+        assert game_state.board.block_fits(block, position), \
+            "%s doesn't fit at %s" % (block, position)
+
+        game_state.drop_block = block
+        game_state.drop_position = position
+        assert game_state.drop_block_is_stuck(), \
+            "%s isn't stuck at %s" % (block, position)
+
+        done_lines = game_state.move_block_down()
+        self.placed_blocks += 1
+        if self.recorder is not None:
+            self.recorder.placement(placement, latency)
+        game_state.start_new_drop()
+
+        if self.recorder is not None and game_state.game_is_over():
+            self.finish()
+        return done_lines
+
+
+class UndoRecord(object):
+    """
+    What GameState.undo() needs to roll back one apply_placement().
+    """
+    def __init__(self, game_state, block, position):
+        self.block = block
+        self.position = position
+
+        self.drop_block = game_state.drop_block
+        self.drop_position = game_state.drop_position
+        self.completed_lines = game_state.completed_lines
+        self.game_over = game_state._game_over
+
+        self.cleared_lines = []
+
+    @property
+    def lines_done(self):
+        return len(self.cleared_lines)
 
 
 class GameState(object):
-    def __init__(self, board):
+    def __init__(self, board, piece_generator=None, preview_size=0):
+        """
+        `piece_generator` is called with no arguments each time a new drop
+        starts and must return the class of the next block. By default
+        blocks are picked at random.
+
+        `preview_size` is the number of upcoming blocks known in advance,
+        kept in `self.preview` (the next one first).
+        """
         self.board = board
+        self.piece_generator = piece_generator or _random_block_class
+
+        self.preview_size = preview_size
+        self.preview = []
 
         self.drop_block = None
         self.drop_position = ()
@@ -150,17 +499,16 @@ class GameState(object):
 
     def start_new_drop(self, block=None):
         if not block:
-           block = random.choice(BLOCKS)()
-           #block = BLOCKS[6]()
+           block = self._next_block_class()()
 
-        LOG.debug("Top Padding: %d" % block.top_padding)
         x, y = block.get_raw_position((self.board.width/2-1,
             self.board.height - block.height + block.top_padding + block.bottom_padding))
 
         while not self.board.block_fits(block, (x,y)):
             real_y = block.get_real_position((x,y))[1]
             if real_y >= self.board.height:
-                LOG.debug("Trying to start new drop with %s but top limit reached" % block)
+                GAME_TRACE.info("Trying to start new drop with %s but top "
+                                "limit reached", block)
                 self._game_over = True
                 return
             y += 1
@@ -168,7 +516,13 @@ class GameState(object):
         self.drop_block = block
         self.drop_position = (x, y)
 
-        LOG.debug("Starting new drop: %s" % self)
+        GAME_TRACE.debug("Starting new drop of %s at %s", block,
+                         self.drop_position)
+
+    def _next_block_class(self):
+        while len(self.preview) <= self.preview_size:
+            self.preview.append(self.piece_generator())
+        return self.preview.pop(0)
 
     def move_block_down(self):
         #LOG.debug("game_state: trying to move down %s at (%d,%d)" %
@@ -177,8 +531,11 @@ class GameState(object):
         x, y = (self.drop_position[0], self.drop_position[1])
 
         if self.drop_block_is_stuck():
+            GAME_TRACE.debug("Placing %s at %s", self.drop_block,
+                             self.drop_position)
             self.board.place_block(self.drop_block, self.drop_position)
-            done_lines = self.clear_completed_lines()
+            done_lines = self.clear_completed_lines(
+                self._block_lines(self.drop_block, self.drop_position))
             return done_lines
         else:
             x, y = (self.drop_position[0], self.drop_position[1]-1)
@@ -199,30 +556,84 @@ class GameState(object):
         self.drop_position = (x, y)
         return True
 
-    def drop_block_is_stuck(self):
-        x_pos, y_pos = self.drop_position
-        drop_block = self.drop_block
+    def step_down(self):
+        """
+        Moves the drop block down one line or, if it's stuck, places it and
+        starts the next drop. Returns the number of lines done.
+        """
+        if self.drop_block_is_stuck():
+            done_lines = self.move_block_down()
+            self.start_new_drop()
+            return done_lines
 
-        if y_pos+drop_block.bottom_padding == 0:
-            return True
+        self.move_block_down()
+        return 0
+
+    def hard_drop(self):
+        """
+        Moves the drop block down as far as it goes, places it and starts
+        the next drop. Returns the number of lines done.
+        """
+        while not self.drop_block_is_stuck():
+            self.move_block_down()
 
-        for x_block in xrange(drop_block.width):
-            column_squares = drop_block.get_solid_squares(x=x_block)
-            if not column_squares:
-                # avoid empty columns
-                continue
-            y_block = column_squares[0][1]
+        done_lines = self.move_block_down()
+        self.start_new_drop()
+        return done_lines
 
-            down_block = self.board.block_at(x_pos+x_block, y_pos+y_block-1)
-            if down_block:
-                return True
-        return False
+    def play_path(self, path):
+        """
+        Moves the drop block along `path` and then step_down(), see
+        follow_path(). Returns the number of lines done, or None (and
+        nothing changes) if the path can't be followed.
+        """
+        end = self.follow_path(path)
+        if end is None:
+            return None
+
+        self.drop_block, self.drop_position = end
+        return self.step_down()
+
+    def follow_path(self, path):
+        """
+        Returns the (block, position) the drop block gets to by doing the
+        actions of `path` (ai.MakeMove, ai.HardDrop and ai.Rotate), or None
+        if some of them can't be done. Nothing is changed.
+        """
+        block = self.drop_block
+        x, y = self.drop_position
+        block_fits = self.board.block_fits
+
+        for action in path:
+            if hasattr(action, "direction"):
+                dx, dy = action.direction
+                if action.times is None:
+                    # as far as it goes (ai.HardDrop)
+                    while block_fits(block, (x+dx, y+dy)):
+                        x += dx
+                        y += dy
+                    continue
+                for i in xrange(action.times):
+                    x += dx
+                    y += dy
+                    if not block_fits(block, (x, y)):
+                        return None
+            else:
+                block = block.get_rotated(action.times)
+                if not block_fits(block, (x, y)):
+                    return None
+
+        return block, (x, y)
+
+    def drop_block_is_stuck(self):
+        x_pos, y_pos = self.drop_position
+        return not self.board.block_fits(self.drop_block, (x_pos, y_pos-1))
 
     def rotate_block(self, times=1):
         if not self._rotation_is_valid(times):
             return False
 
-        self.drop_block.rotate(times)
+        self.drop_block = self.drop_block.get_rotated(times)
 
         return True
 
@@ -230,40 +641,106 @@ class GameState(object):
         rotated = self.drop_block.get_rotated(times)
         return self.board.block_fits(rotated, self.drop_position)
 
-    def clear_completed_lines(self):
-        lines_done = 0
-        # we must start from the top so the clearing
-        # doesn't affect this loop
-        for y in reversed(range(self.board.height)):
-            is_done = True
-            for x in range(self.board.width):
-                block = self.board.block_at(x, y)
-                if not block:
-                    is_done = False
-                    break
-
-            if is_done:
-                LOG.debug("Clearing line %d" % y)
-                self.board.clear_line(y)
-                lines_done += 1
-
-        self.completed_lines += lines_done
-
-        return lines_done
+    def clear_completed_lines(self, y_lines=None):
+        """
+        Clears the completed lines among `y_lines` (all the lines of the
+        board by default) and returns how many were cleared.
+        """
+        return len(self._clear_completed_lines(y_lines))
+
+    def _clear_completed_lines(self, y_lines=None):
+        """
+        Returns a list of (y, line) with the cleared lines, as returned by
+        TetrisBoard.clear_lines().
+        """
+        if y_lines is None:
+            y_lines = xrange(self.board.height)
+
+        completed = [y for y in y_lines if self.board.line_is_complete(y)]
+        if not completed:
+            return []
+
+        GAME_TRACE.debug("Clearing lines %s", completed)
+        cleared = self.board.clear_lines(completed)
+        self.completed_lines += len(cleared)
+
+        return cleared
+
+    def _block_lines(self, block, position):
+        """
+        Lines of the board with squares of `block` at `position`.
+        """
+        y = position[1]
+        return xrange(max(y + block.bottom_padding, 0),
+                      min(y + block.height - block.top_padding,
+                          self.board.height))
+
+    def apply_placement(self, block, position):
+        """
+        Places `block` at `position` and clears the completed lines, like
+        locking the drop block there would do, but without starting a new
+        drop.
+
+        Returns an UndoRecord to give to undo() to get back to the state
+        before this call.
+        """
+        record = UndoRecord(self, block, position)
+        self.board.place_block(block, position)
+        record.cleared_lines = self._clear_completed_lines(
+            self._block_lines(block, position))
+        return record
+
+    def undo(self, record):
+        """
+        Rolls back the apply_placement() that returned `record`. Records
+        must be undone in the reverse order they were applied.
+        """
+        self.board.restore_lines(record.cleared_lines)
+        self.board.remove_block(record.block, record.position)
+
+        self.drop_block = record.drop_block
+        self.drop_position = record.drop_position
+        self.completed_lines = record.completed_lines
+        self._game_over = record.game_over
+
+    def copy(self):
+        """
+        Returns a copy of this state with its own board, cheaper than a
+        deepcopy. The piece generator is shared with the copy.
+        """
+        state = copy.copy(self)
+        state.board = self.board.copy()
+        state.preview = list(self.preview)
+        return state
 
     def game_is_over(self):
         return self._game_over
 
+    def drop_state(self):
+        """
+        What a path found by a search depends on: the drop block, where it
+        is and the board. A path is stale once this changes.
+        """
+        return (self.drop_block, self.drop_position, self.board.zobrist_hash)
+
     def __str__(self):
         return "<Drop block: %s, position: %s>" % (self.drop_block,
                                                    repr(self.drop_position))
 
     def board_print(self):
+        return "\n".join(map("".join, self.board_frame()))
+
+    def board_frame(self):
+        """
+        Returns the drawing of the game as a list of lines, each one a list
+        of glyphs: strings that take exactly one column of the terminal
+        (a character, possibly wrapped in color escape codes).
+        """
         out = []
 
-        drop_block_positions = map(lambda (x,y): (self.drop_position[0]+x,
-                                                  self.drop_position[1]+y),
-                                   self.drop_block.get_solid_squares())
+        drop_block_positions = set((self.drop_position[0]+x,
+                                    self.drop_position[1]+y)
+                                   for (x,y) in self.drop_block.get_solid_squares())
 
         for y in reversed(xrange(self.board.height)):
             line_str = [" ",] * (self.board.width*3)
@@ -296,20 +773,29 @@ class GameState(object):
 
         # apply borders
         for i,line in enumerate(out):
-            line.insert(0, "%2d|"%(self.board.height-i-1))
+            line[0:0] = list("%2d|"%(self.board.height-i-1))
             line.append("|")
 
-        out.insert(0, ["  +"]+["-",]*(self.board.width*3) + ["+"])
-        out.append(["  +"]+["-",]*(self.board.width*3) + ["+"])
+        out.insert(0, list("  +")+["-",]*(self.board.width*3) + ["+"])
+        out.append(list("  +")+["-",]*(self.board.width*3) + ["+"])
 
         l = "   " + "".join(map(lambda i: "|%d|"%i, xrange(self.board.width)))
-        out.append(l)
+        out.append(list(l))
 
-        out_str = "\n".join(map("".join, out))
+        out.append(list("Done lines: %d" % self.completed_lines))
 
-        out_str += "\nDone lines: %d" % self.completed_lines
+        if self.preview:
+            line = list("Next:")
+            for b in self.preview:
+                line.append(" ")
+                line.extend(paint_block_color(c, b, True)
+                            for c in b.__name__[len("Block"):])
+            out.append(line)
 
         if self._game_over:
-            out_str += "\n------ GAME OVER!!!! --------"
+            out.append(list("------ GAME OVER!!!! --------"))
+
+        return out
 
-        return out_str
+def _random_block_class():
+    return random.choice(BLOCKS)
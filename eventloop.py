@@ -0,0 +1,155 @@
+"""
+A small single-threaded event loop, in the spirit of asyncio (which
+Python 2 doesn't have): timers, file descriptor readers and an executor
+of threads for blocking or CPU heavy work.
+
+Callbacks run one at a time on the thread of run_forever(), so the state
+they share needs no locks. Only call_soon_threadsafe() may be called from
+other threads.
+"""
+import time
+import heapq
+import select
+from collections import deque
+from multiprocessing.pool import ThreadPool
+
+from log import LOG
+from gravity import Waker
+
+
+class Handle(object):
+    """
+    A scheduled callback, which can be cancelled before it runs.
+    """
+    __slots__ = ("callback", "args", "cancelled")
+
+    def __init__(self, callback, args):
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+    def _run(self):
+        try:
+            self.callback(*self.args)
+        except Exception:
+            LOG.error("Exception in callback %r" % self.callback, exc_info=True)
+
+
+class EventLoop(object):
+    def __init__(self, executor_threads=None):
+        """
+        `executor_threads` is the size of the thread pool used by
+        run_in_executor() (the number of cores by default), created the
+        first time it's needed.
+        """
+        self.executor_threads = executor_threads
+
+        self._ready = deque()
+        # heap of (when, sequence number, handle)
+        self._timers = []
+        self._sequence = 0
+        self._readers = {}
+
+        # wakes select() up when another thread schedules something
+        self._waker = Waker()
+        self._executor = None
+        self._stopping = False
+
+    def time(self):
+        return time.time()
+
+    def call_soon(self, callback, *args):
+        handle = Handle(callback, args)
+        self._ready.append(handle)
+        return handle
+
+    def call_soon_threadsafe(self, callback, *args):
+        # deque.append() is atomic
+        handle = self.call_soon(callback, *args)
+        self._waker.wake()
+        return handle
+
+    def call_later(self, delay, callback, *args):
+        return self.call_at(self.time() + delay, callback, *args)
+
+    def call_at(self, when, callback, *args):
+        handle = Handle(callback, args)
+        self._sequence += 1
+        heapq.heappush(self._timers, (when, self._sequence, handle))
+        return handle
+
+    def add_reader(self, fd, callback, *args):
+        """
+        Calls `callback` each time `fd` (a file descriptor or anything with
+        a fileno() method) is readable.
+        """
+        self._readers[fd] = Handle(callback, args)
+
+    def remove_reader(self, fd):
+        self._readers.pop(fd, None)
+
+    def run_in_executor(self, callback, func, *args):
+        """
+        Calls `func(*args)` on a thread of the executor, then `callback`
+        with its result, on the loop. If `func` raises, the exception is
+        logged and `callback` isn't called.
+        """
+        if self._executor is None:
+            self._executor = ThreadPool(self.executor_threads)
+
+        def run():
+            try:
+                result = func(*args)
+            except Exception:
+                LOG.error("Exception in executor call %r" % func, exc_info=True)
+                return
+            self.call_soon_threadsafe(callback, result)
+        self._executor.apply_async(run)
+
+    def stop(self):
+        """
+        Makes run_forever() return, after the callbacks already due run.
+        """
+        self._stopping = True
+        self._waker.wake()
+
+    def run_forever(self):
+        self._stopping = False
+        while not self._stopping:
+            self._run_once()
+
+    def _run_once(self):
+        timeout = None
+        if self._ready:
+            timeout = 0
+        elif self._timers:
+            timeout = max(self._timers[0][0] - self.time(), 0)
+
+        readable = select.select([self._waker] + self._readers.keys(),
+                                 [], [], timeout)[0]
+        for fd in readable:
+            if fd is self._waker:
+                self._waker.clear()
+            elif fd in self._readers:
+                self._ready.append(self._readers[fd])
+
+        now = self.time()
+        timers = self._timers
+        while timers and timers[0][0] <= now:
+            self._ready.append(heapq.heappop(timers)[2])
+
+        # callbacks scheduled by these ones wait for the next iteration
+        for i in xrange(len(self._ready)):
+            handle = self._ready.popleft()
+            if not handle.cancelled:
+                handle._run()
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.close()
+            self._executor.join()
+            self._executor = None
+        self._waker.close()
@@ -2,6 +2,7 @@
 import sys
 import time
 import os
+import select
 import traceback
 # keyboard input
 import tty
@@ -9,9 +10,14 @@ import termios
 
 from log import LOG
 
-from board import TetrisBoard
-from engine import TetrisEngine, GameState
-from ai import TetrisAI
+from board import BitboardTetrisBoard
+from engine import TetrisEngine, AsyncTetrisEngine, GameState
+from ai import TetrisAI, AsyncTetrisAI, BoardEvaluator
+from tuner import load_weights
+from eventloop import EventLoop
+from render import TerminalRenderer
+from metrics import METRICS, MetricsDumper
+from recording import GameRecorder
 
 LEFT_KEY = '\x1b[D'
 RIGHT_KEY = '\x1b[C'
@@ -19,19 +25,38 @@ UP_KEY = '\x1b[A'
 DOWN_KEY = '\x1b[B'
 DROP_KEY = ' '
 
-def getch():
+def getch(engine=None):
+    """
+    Waits for a key, returns None if `engine` stops first.
+    """
     fd = sys.stdin.fileno()
     old = termios.tcgetattr(fd)
     try:
         tty.setcbreak(fd)
+        if engine is not None \
+                and fd not in select.select([fd, engine], [], [])[0]:
+            return None
         #return sys.stdin.read(1)
         return os.read(fd, 4)
     finally:
         termios.tcsetattr(fd, termios.TCSADRAIN, old)
 
+def handle_key(engine, c):
+    if c == LEFT_KEY:
+        engine.move_left()
+    if c == RIGHT_KEY:
+        engine.move_right()
+    if c == DOWN_KEY:
+        engine.move_down()
+    if c == DROP_KEY:
+        engine.drop_block()
+    if c == UP_KEY:
+        engine.rotate()
+
 class TetrisGame:
-    def __init__(self):
-        self.game_state = GameState(TetrisBoard())
+    def __init__(self, board_class=BitboardTetrisBoard, preview_size=1,
+                 level=None, recorder=None, evaluator=None):
+        self.game_state = GameState(board_class(), preview_size=preview_size)
 
         #from blocks import BlockLine, BlockRightL, BlockCube
         #l = BlockLine()
@@ -43,38 +68,88 @@ class TetrisGame:
         #self.game_state.board.place_block(r, (1,0))
         #self.game_state.board.place_block(c, (8,0))
 
-        self.engine = TetrisEngine(self.game_state)
-        self.ai = TetrisAI(self.engine)
+        self.engine = TetrisEngine(self.game_state, level=level,
+                                   recorder=recorder)
+        self.ai = TetrisAI(self.engine, evaluator=evaluator)
 
     def run_main(self):
         self.engine.start()
-
-        while not self.engine.running():
-            pass
-
         self.ai.play()
 
         while self.engine.running():
             try:
-                c = getch()
-                if c == LEFT_KEY:
-                    self.engine.move_left()
-                if c == RIGHT_KEY:
-                    self.engine.move_right()
-                if c == DOWN_KEY:
-                    self.engine.move_down()
-                if c == DROP_KEY:
-                    self.engine.drop_block()
-                if c == UP_KEY:
-                    self.engine.rotate()
+                handle_key(self.engine, getch(self.engine))
             except KeyboardInterrupt:
                 self.engine.stop()
+        self.engine.stop()
+
+class AsyncTetrisGame:
+    """
+    TetrisGame on an event loop: gravity, the AI moves and the keys read
+    from stdin are all callbacks of a single thread.
+    """
+    def __init__(self, board_class=BitboardTetrisBoard, preview_size=1,
+                 level=None, recorder=None, evaluator=None):
+        self.game_state = GameState(board_class(), preview_size=preview_size)
+
+        self.loop = EventLoop()
+        self.engine = AsyncTetrisEngine(self.game_state, self.loop,
+                                        level=level,
+                                        renderer=TerminalRenderer(),
+                                        on_stop=self.loop.stop,
+                                        recorder=recorder)
+        self.ai = AsyncTetrisAI(self.engine, evaluator=evaluator)
+
+    def run_main(self):
+        fd = sys.stdin.fileno()
+        old = termios.tcgetattr(fd)
+        tty.setcbreak(fd)
+        try:
+            self.loop.add_reader(fd, self._read_key, fd)
+            self.engine.start()
+            self.ai.play()
+            self.loop.run_forever()
+        except KeyboardInterrupt:
+            self.engine.stop()
+        finally:
+            termios.tcsetattr(fd, termios.TCSADRAIN, old)
+            self.loop.close()
+
+    def _read_key(self, fd):
+        handle_key(self.engine, os.read(fd, 4))
 
 if __name__ == "__main__":
-    game = TetrisGame()
+    # --record=FILE records the game, replay it with recording.py
+    # --weights=FILE plays with the best weights of a tuner.py checkpoint
+    recorder = None
+    evaluator = None
+    for arg in sys.argv[1:]:
+        if arg.startswith("--record="):
+            recorder = GameRecorder(open(arg.partition("=")[2], "wb"))
+        if arg.startswith("--weights="):
+            evaluator = BoardEvaluator(load_weights(arg.partition("=")[2]))
+
+    if "--async" in sys.argv[1:]:
+        game = AsyncTetrisGame(recorder=recorder, evaluator=evaluator)
+    else:
+        game = TetrisGame(recorder=recorder, evaluator=evaluator)
+
+    # --metrics shows them below the game, --metrics=FILE appends them to FILE
+    dumper = None
+    for arg in sys.argv[1:]:
+        if arg.startswith("--metrics"):
+            dumper = MetricsDumper(METRICS, path=arg.partition("=")[2] or None,
+                                   interval=1.0)
+            dumper.start()
+
     try:
         game.run_main()
     except:
         LOG.debug("Main thread just crashed!!", exc_info=True)
         traceback.print_exc()
         game.engine.stop()
+    finally:
+        if dumper:
+            dumper.stop()
+        if recorder:
+            recorder.close()
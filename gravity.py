@@ -0,0 +1,81 @@
+import os
+import errno
+import fcntl
+import select
+import threading
+
+# seconds the drop block takes to fall one line at each gravity level
+# (from the NES version frame counts, at 60 frames per second)
+GRAVITY_LEVELS = [frames / 60.0 for frames in
+                  (48, 43, 38, 33, 28, 23, 18, 13, 8, 6,
+                   5, 5, 5, 4, 4, 4, 3, 3, 3, 2,
+                   2, 2, 2, 2, 2, 2, 2, 2, 2, 1)]
+
+
+def gravity_interval(level):
+    """
+    Seconds per line at `level`, levels above the last one keep its speed.
+    """
+    return GRAVITY_LEVELS[min(level, len(GRAVITY_LEVELS)-1)]
+
+
+class Waker(object):
+    """
+    Lets a thread sleep until a deadline or until another thread wakes it,
+    whichever comes first.
+
+    Built on a pipe and select(), so the sleeping thread is blocked in the
+    kernel the whole time: no polling, and it wakes right at the deadline
+    (threading.Condition.wait() with a timeout polls on Python 2).
+
+    Once closed, wake() does nothing, so other threads can still call it.
+    """
+    def __init__(self):
+        self._read_fd, self._write_fd = os.pipe()
+        for fd in (self._read_fd, self._write_fd):
+            flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+            fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+        self._closed = False
+        # closing while another thread writes could write to a reused fd
+        self._lock = threading.Lock()
+
+    def fileno(self):
+        return self._read_fd
+
+    def wake(self):
+        with self._lock:
+            if self._closed:
+                return
+            try:
+                os.write(self._write_fd, "x")
+            except OSError, e:
+                # a full pipe means there are wake ups pending already
+                if e.errno != errno.EAGAIN:
+                    raise
+
+    def wait(self, timeout=None):
+        """
+        Sleeps for at most `timeout` seconds (forever if None). Returns
+        True if woken up by wake(), False if the timeout expired.
+        """
+        readable = select.select([self._read_fd], [], [], timeout)[0]
+        if not readable:
+            return False
+        self.clear()
+        return True
+
+    def clear(self):
+        try:
+            while os.read(self._read_fd, 4096):
+                pass
+        except OSError, e:
+            if e.errno != errno.EAGAIN:
+                raise
+
+    def close(self):
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            os.close(self._read_fd)
+            os.close(self._write_fd)
@@ -0,0 +1,257 @@
+#!/usr/bin/python
+"""
+Game host: runs many AI games side by side in one process, with no
+threads per game.
+
+All the engines are eventloop.EventLoop engines (engine.AsyncTetrisEngine)
+sharing one loop, so gravity for every game is a timer of the same
+scheduler. The searches run on a bounded pool of worker processes that
+serves the decision requests of all the games:
+
+    - fairness: a game has at most one request, waiting or being searched,
+      and waiting requests are served in turns (round robin), so a game
+      never gets two decisions while another one waits for its first.
+
+    - backpressure: at most `workers` searches are sent to the pool at a
+      time. The rest wait in the host, not in the pool, and the state to
+      search is copied when the request is sent to a worker, not when the
+      game asks, so waiting doesn't make searches stale. Decisions that
+      come back for a state gravity already changed are dropped and the
+      game asks again.
+
+    python host.py --games 16 --workers 4 --level 10 --duration 60
+    python host.py --weights tuner_checkpoint.json
+"""
+import sys
+import time
+import argparse
+import functools
+import multiprocessing
+from collections import deque
+
+from log import LOG, init_worker
+
+from board import BitboardTetrisBoard
+from engine import AsyncTetrisEngine, GameState
+from eventloop import EventLoop
+from pieces import PIECE_GENERATORS
+from ai import PossiblePlacementsAlgorithm, SearchBudget
+from metrics import METRICS
+from simulate import ALGORITHMS, make_evaluator
+import tuner
+
+# evaluators of a worker by weights, kept from a search to the next for
+# their transposition tables
+_evaluators = {}
+
+
+def _find_path(algorithm_class, game_state, budget, weights=None):
+    """
+    Runs on the workers. Returns (path, seconds it took to find it), or
+    None if the search failed.
+    """
+    try:
+        a = time.time()
+        kwargs = {}
+        if weights is not None:
+            key = (algorithm_class, tuple(sorted(weights.iteritems())))
+            if key not in _evaluators:
+                _evaluators[key] = make_evaluator(algorithm_class, weights)
+            kwargs["evaluator"] = _evaluators[key]
+        algorithm = algorithm_class(game_state, budget=budget, **kwargs)
+        algorithm.go()
+        return algorithm.optimal_path, time.time()-a
+    except Exception:
+        LOG.error("Search failed", exc_info=True)
+        return None
+
+
+class HostedGame(object):
+    def __init__(self, name, engine):
+        self.name = name
+        self.engine = engine
+
+        # decisions played, and dropped because the game moved on
+        self.decisions = 0
+        self.stale_decisions = 0
+
+        # when the game asked for its waiting decision
+        self._requested_at = None
+
+    @property
+    def lines(self):
+        return self.engine.game_state.completed_lines
+
+    def __str__(self):
+        return "<HostedGame %s: %d lines, %d decisions, %d stale%s>" % (
+            self.name, self.lines, self.decisions, self.stale_decisions,
+            ", game over" if self.engine.game_state.game_is_over() else "")
+
+
+class GameHost(object):
+    def __init__(self, loop=None, workers=None,
+                 algorithm_class=PossiblePlacementsAlgorithm, weights=None):
+        """
+        `workers` is the number of worker processes (the number of cores
+        by default), which is also the number of searches sent to them at
+        a time. The searches score boards with `weights`, if given.
+        """
+        self.loop = loop or EventLoop()
+        self.workers = workers or multiprocessing.cpu_count()
+        self.algorithm_class = algorithm_class
+        self.weights = weights
+
+        self.games = []
+        self._playing = 0
+        # games waiting for a worker, in turn order
+        self._waiting = deque()
+        self._in_flight = 0
+
+        self._pool = multiprocessing.Pool(self.workers, init_worker)
+
+    def add_game(self, game_state, level=None, recorder=None, name=None):
+        """
+        Adds a game to play on `game_state`, which starts with run().
+        Returns its HostedGame.
+        """
+        game = HostedGame(name or str(len(self.games)), None)
+        game.engine = AsyncTetrisEngine(
+            game_state, self.loop, level=level, recorder=recorder,
+            on_stop=functools.partial(self._game_stopped, game))
+        self.games.append(game)
+        return game
+
+    def run(self, duration=None):
+        """
+        Plays all the games until they're over, or for `duration` seconds
+        at most. Returns the list of HostedGame.
+        """
+        LOG.debug("Hosting %d games with %d workers" % (len(self.games),
+                                                        self.workers))
+        for game in self.games:
+            self._playing += 1
+            game.engine.start()
+            self._request(game)
+
+        if duration is not None:
+            self.loop.call_later(duration, self.stop)
+        if self._playing:
+            self.loop.run_forever()
+        return self.games
+
+    def stop(self):
+        for game in self.games:
+            game.engine.stop()
+
+    def close(self):
+        self._pool.terminate()
+        self._pool.join()
+        self.loop.close()
+
+    def _game_stopped(self, game):
+        LOG.debug("Game %s stopped with %d lines" % (game.name, game.lines))
+        self._playing -= 1
+        if not self._playing:
+            self.loop.stop()
+
+    def _request(self, game):
+        if game.engine.running():
+            game._requested_at = self.loop.time()
+            self._waiting.append(game)
+        METRICS.average("host.waiting_games").add(len(self._waiting))
+        self._dispatch()
+
+    def _dispatch(self):
+        while self._waiting and self._in_flight < self.workers:
+            game = self._waiting.popleft()
+            if not game.engine.running():
+                continue
+
+            METRICS.histogram("host.queue_wait").add(
+                self.loop.time() - game._requested_at)
+
+            game_state = game.engine.game_state.copy()
+            # searches never draw blocks, and the generator may not pickle
+            game_state.piece_generator = None
+            budget = SearchBudget.for_drop(game_state,
+                                           game.engine.time_to_drop())
+
+            self._in_flight += 1
+            self._pool.apply_async(
+                _find_path, (self.algorithm_class, game_state, budget,
+                             self.weights),
+                callback=functools.partial(self._search_done, game,
+                                           game_state.drop_state()))
+
+    def _search_done(self, game, drop_state, result):
+        # called on a thread of the pool
+        self.loop.call_soon_threadsafe(self._decided, game, drop_state,
+                                       result)
+
+    def _decided(self, game, drop_state, result):
+        self._in_flight -= 1
+        if game.engine.running() and result is not None:
+            # the path is only good for the state it was searched from,
+            # the engine doesn't play it if gravity changed that state
+            if game.engine.execute(*result, expected=drop_state) is not None:
+                game.decisions += 1
+            else:
+                game.stale_decisions += 1
+                METRICS.counter("host.stale_decisions").inc()
+        # to the back of the turns
+        self._request(game)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("-n", "--games", type=int, default=8)
+    parser.add_argument("-j", "--workers", type=int, default=None,
+                        help="number of worker processes "
+                             "(default: all the cores)")
+    parser.add_argument("--level", type=int, default=None)
+    parser.add_argument("--duration", type=float, default=None,
+                        help="stop the games after this many seconds")
+    parser.add_argument("--algorithm", choices=sorted(ALGORITHMS),
+                        default="placements")
+    parser.add_argument("--sequence", choices=sorted(PIECE_GENERATORS),
+                        default="uniform")
+    parser.add_argument("--preview", type=int, default=0)
+    parser.add_argument("--seed", type=int, default=0,
+                        help="seed of the first game, the next ones follow")
+    parser.add_argument("--weights", metavar="CHECKPOINT",
+                        help="play with the best weights of a tuner.py "
+                             "checkpoint")
+    args = parser.parse_args(argv)
+
+    LOG.disable(LOG.DEBUG)
+
+    weights = tuner.load_weights(args.weights) if args.weights else None
+    host = GameHost(workers=args.workers,
+                    algorithm_class=ALGORITHMS[args.algorithm],
+                    weights=weights)
+    for i in xrange(args.games):
+        seed = args.seed + i
+        game_state = GameState(BitboardTetrisBoard(),
+                               PIECE_GENERATORS[args.sequence](seed),
+                               args.preview)
+        host.add_game(game_state, level=args.level, name="seed %d" % seed)
+
+    start_time = time.time()
+    try:
+        games = host.run(args.duration)
+    finally:
+        host.close()
+
+    for game in games:
+        print game
+    lines = [game.lines for game in games]
+    print "Lines: mean %.1f, min %d, max %d" % (
+        float(sum(lines)) / len(lines), min(lines), max(lines))
+    print "Queue wait: p50 %.2fms, p99 %.2fms" % (
+        METRICS.histogram("host.queue_wait").percentile(50) * 1000,
+        METRICS.histogram("host.queue_wait").percentile(99) * 1000)
+    print "Wall time: %.1fs" % (time.time() - start_time)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
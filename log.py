@@ -3,3 +3,12 @@ import logging
 FORMAT = "%(asctime)s - %(levelname)s - %(threadName)s - %(funcName)s():\t %(message)s"
 logging.basicConfig(level=logging.DEBUG, filename="log", format=FORMAT)
 LOG = logging
+
+
+def init_worker(log=False):
+    """
+    Initializer of the worker processes of a multiprocessing.Pool: they
+    only log debug messages if `log` is true.
+    """
+    if not log:
+        LOG.disable(LOG.DEBUG)
@@ -0,0 +1,266 @@
+"""
+Counters, histograms and moving averages of what the game and the AI do,
+kept in a registry that can be queried at any time:
+
+    METRICS.counter("search.nodes").inc(search.visited_states)
+
+    with METRICS.timer("search.time"):
+        search.go()
+
+    METRICS.histogram("search.time").percentile(99)
+    METRICS.snapshot()
+
+Times are in seconds. A MetricsDumper writes the registry periodically to
+a file, or to a status line on the terminal.
+"""
+import sys
+import time
+import json
+import threading
+
+# timings are kept in buckets of this size (in seconds)
+HISTOGRAM_RESOLUTION = 0.0001
+
+# weight of the newest value in moving averages
+MOVING_AVERAGE_ALPHA = 0.1
+
+
+class Counter(object):
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, n=1):
+        with self._lock:
+            self.value += n
+
+    def snapshot(self):
+        return self.value
+
+
+class MovingAverage(object):
+    """
+    Exponential moving average, recent values weigh more.
+    """
+    def __init__(self, alpha=MOVING_AVERAGE_ALPHA):
+        self.alpha = alpha
+        self.value = None
+
+    def add(self, value):
+        if self.value is None:
+            self.value = float(value)
+        else:
+            self.value += self.alpha * (value - self.value)
+
+    def snapshot(self):
+        return self.value
+
+
+class Histogram(object):
+    """
+    Counts the values in buckets of `resolution` width, so percentiles can
+    be read without keeping every value. It also keeps a moving average.
+    """
+    def __init__(self, resolution=HISTOGRAM_RESOLUTION):
+        self.resolution = resolution
+        self.buckets = {}
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.average = MovingAverage()
+        self._lock = threading.Lock()
+
+    def add(self, value):
+        bucket = int(value / self.resolution)
+        with self._lock:
+            self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+            self.count += 1
+            self.total += value
+            if value > self.max:
+                self.max = value
+            self.average.add(value)
+
+    def merge(self, other):
+        """
+        Adds the values counted by `other`, a Histogram with the same
+        resolution. The moving average is left as it is.
+        """
+        assert other.resolution == self.resolution, "Different resolutions"
+        with self._lock:
+            for bucket, count in other.buckets.iteritems():
+                self.buckets[bucket] = self.buckets.get(bucket, 0) + count
+            self.count += other.count
+            self.total += other.total
+            self.max = max(self.max, other.max)
+
+    def __getstate__(self):
+        # pickled without the lock, to be sent back by worker processes
+        state = self.__dict__.copy()
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    @property
+    def mean(self):
+        if not self.count:
+            return 0.0
+        return self.total / self.count
+
+    def percentile(self, percent):
+        """
+        Returns the upper limit of the bucket holding the `percent`
+        percentile, 0 if there are no values.
+        """
+        with self._lock:
+            if not self.count:
+                return 0.0
+
+            wanted = self.count * percent / 100.0
+            seen = 0
+            for bucket in sorted(self.buckets):
+                seen += self.buckets[bucket]
+                if seen >= wanted:
+                    break
+            return (bucket+1) * self.resolution
+
+    def snapshot(self):
+        return {"count": self.count,
+                "mean": self.mean,
+                "average": self.average.value,
+                "p50": self.percentile(50),
+                "p99": self.percentile(99),
+                "max": self.max}
+
+
+class Timer(object):
+    """
+    Context manager adding the seconds spent in its block to a Histogram.
+    """
+    __slots__ = ("histogram", "start")
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.add(time.time() - self.start)
+
+
+class MetricsRegistry(object):
+    """
+    Metrics by name, created the first time they're asked for.
+    """
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _get(self, name, metric_class):
+        metric = self._metrics.get(name)
+        if metric is None:
+            with self._lock:
+                metric = self._metrics.setdefault(name, metric_class())
+        assert isinstance(metric, metric_class), \
+            "%s is a %s" % (name, metric.__class__.__name__)
+        return metric
+
+    def counter(self, name):
+        return self._get(name, Counter)
+
+    def histogram(self, name):
+        return self._get(name, Histogram)
+
+    def average(self, name):
+        return self._get(name, MovingAverage)
+
+    def timer(self, name):
+        return Timer(self.histogram(name))
+
+    def names(self):
+        return sorted(self._metrics)
+
+    def get(self, name):
+        return self._metrics.get(name)
+
+    def reset(self):
+        with self._lock:
+            self._metrics.clear()
+
+    def snapshot(self):
+        """
+        Returns a dict of name -> value (a dict for histograms).
+        """
+        return dict((name, self._metrics[name].snapshot())
+                    for name in self.names())
+
+    def status_line(self):
+        """
+        The metrics in a single line: counters, averages and the moving
+        average of each histogram (in ms, they're mostly timings).
+        """
+        out = []
+        for name in self.names():
+            metric = self._metrics[name]
+            if isinstance(metric, Histogram):
+                if metric.average.value is not None:
+                    out.append("%s %.2fms" % (name, metric.average.value*1000))
+            elif isinstance(metric, MovingAverage):
+                if metric.value is not None:
+                    out.append("%s %.2f" % (name, metric.value))
+            else:
+                out.append("%s %d" % (name, metric.value))
+        return " | ".join(out)
+
+
+METRICS = MetricsRegistry()
+
+
+class MetricsDumper(object):
+    """
+    Writes the metrics of `registry` every `interval` seconds, from its own
+    thread: as a JSON line appended to `path` or, if there is no `path`, as
+    a status line on stderr.
+    """
+    def __init__(self, registry=METRICS, path=None, interval=5.0):
+        self.registry = registry
+        self.path = path
+        self.interval = interval
+
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(target=self._run_thread,
+                                        name="metricsThread")
+        self._thread.daemon = True
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        """
+        Writes the metrics one last time and stops the thread.
+        """
+        self._stop_event.set()
+        if self._thread.is_alive():
+            self._thread.join()
+
+    def dump(self):
+        if self.path:
+            line = json.dumps({"time": time.time(),
+                               "metrics": self.registry.snapshot()},
+                              sort_keys=True)
+            with open(self.path, "a") as f:
+                f.write(line + "\n")
+        else:
+            sys.stderr.write("\r\033[K" + self.registry.status_line())
+            sys.stderr.flush()
+
+    def _run_thread(self):
+        while not self._stop_event.is_set():
+            # a timeout in Event.wait() polls on Python 2, but only about
+            # every 50ms, which is nothing for a dump every few seconds
+            self._stop_event.wait(self.interval)
+            self.dump()
@@ -0,0 +1,43 @@
+import random
+
+from blocks import BLOCKS
+
+
+class UniformPieceGenerator(object):
+    """
+    Each block is picked independently and uniformly from BLOCKS.
+
+    Instances are meant to be used as the `piece_generator` of a GameState:
+    each call returns the class of the next block. The same `seed` always
+    gives the same sequence.
+    """
+    def __init__(self, seed=None):
+        self.seed = seed
+        self._rng = random.Random(seed)
+
+    def __call__(self):
+        return self._rng.choice(BLOCKS)
+
+
+class BagPieceGenerator(object):
+    """
+    "7-bag" sequence: the blocks are dealt from a bag holding one of each
+    block, shuffled, and the bag is refilled once it's empty. There are
+    never more than 12 blocks between two blocks of the same kind.
+    """
+    def __init__(self, seed=None):
+        self.seed = seed
+        self._rng = random.Random(seed)
+        self._bag = []
+
+    def __call__(self):
+        if not self._bag:
+            self._bag = list(BLOCKS)
+            self._rng.shuffle(self._bag)
+        return self._bag.pop()
+
+
+PIECE_GENERATORS = {
+    "uniform": UniformPieceGenerator,
+    "bag": BagPieceGenerator,
+}
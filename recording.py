@@ -0,0 +1,345 @@
+#!/usr/bin/python
+"""
+Binary recordings of games, and a replayer that plays them back through
+GameState headlessly, as fast as the CPU allows.
+
+A recording is a stream of games. Each game starts with a header (seed
+and preview size) followed by events: the blocks as the piece generator
+gives them, the moves (engine actions, whole paths or final placements,
+these with the time it took to decide them) and an end event with the
+lines done and the Zobrist hash of the final board, so a replay can check
+it got to the same game.
+
+    recorder = GameRecorder(open("game.rec", "wb"))
+    engine = HeadlessTetrisEngine(seed, recorder=recorder)
+    ...
+
+    python recording.py game.rec
+"""
+import sys
+import time
+import struct
+import argparse
+import collections
+
+from log import LOG
+
+from blocks import BLOCKS
+from board import BitboardTetrisBoard
+from engine import HeadlessTetrisEngine
+from ai import MakeMove, Rotate, HardDrop, Direction
+
+MAGIC = "TTRC"
+VERSION = 1
+
+# little endian, the first byte of each event is its type
+HEADER = struct.Struct("<4sBBBq")   # magic, version, preview size, has seed, seed
+PIECE = struct.Struct("<cB")        # "p", block kind
+ACTION = struct.Struct("<cB")       # "a", action
+PLACEMENT = struct.Struct("<cBbbI") # "l", rotation, x, y, latency
+PATH = struct.Struct("<cIB")        # "x", latency, number of steps
+PATH_STEP = struct.Struct("<BB")    # action, times
+END = struct.Struct("<cIQ")         # "e", lines, board hash
+
+# latencies are kept in microseconds
+NO_LATENCY = 0xffffffff
+
+# actions
+LEFT = 1
+RIGHT = 2
+DOWN = 3
+ROTATE = 4
+DROP = 5
+HARD_DROP = 6
+
+# TetrisEngine methods that are recorded, all the others are ignored
+ENGINE_ACTIONS = {"move_left": LEFT,
+                  "move_right": RIGHT,
+                  "move_down": DOWN,
+                  "rotate": ROTATE,
+                  "drop_block": DROP}
+
+_DIRECTIONS = {Direction.LEFT: LEFT,
+               Direction.RIGHT: RIGHT,
+               Direction.DOWN: DOWN}
+
+
+def _encode_latency(latency):
+    if latency is None:
+        return NO_LATENCY
+    return min(int(latency * 1000000), NO_LATENCY - 1)
+
+
+def _decode_latency(latency):
+    if latency == NO_LATENCY:
+        return None
+    return latency / 1000000.0
+
+
+class GameRecorder(object):
+    """
+    Writes games to the binary file object `out`. The engines call it, see
+    the `recorder` argument of the engine classes.
+
+    Events between end_game() and the next start_game() are ignored.
+    """
+    def __init__(self, out):
+        self.out = out
+        self._in_game = False
+
+    def start_game(self, game_state, seed=None):
+        """
+        Writes the header of a new game and records the blocks
+        `game_state` gets from now on.
+        """
+        if self._in_game:
+            self.end_game(game_state)
+
+        self.out.write(HEADER.pack(MAGIC, VERSION, game_state.preview_size,
+                                   seed is not None, seed or 0))
+        game_state.piece_generator = _RecordedPieces(
+            game_state.piece_generator, self)
+        self._in_game = True
+
+    def piece(self, block_class):
+        if self._in_game:
+            self.out.write(PIECE.pack("p", block_class.kind))
+
+    def action(self, name, args=()):
+        """
+        Records the call of TetrisEngine method `name` with `args`.
+        """
+        if not self._in_game:
+            return
+
+        if name == "execute":
+            self.path(*args)
+        elif name in ENGINE_ACTIONS:
+            self.out.write(ACTION.pack("a", ENGINE_ACTIONS[name]))
+
+    def path(self, path, latency=None):
+        if not self._in_game:
+            return
+
+        path = getattr(path, "path", path)
+        steps = []
+        for action in path:
+            if isinstance(action, HardDrop):
+                steps.append(PATH_STEP.pack(HARD_DROP, 1))
+            elif isinstance(action, Rotate):
+                steps.append(PATH_STEP.pack(ROTATE, action.times % 4))
+            else:
+                steps.append(PATH_STEP.pack(_DIRECTIONS[action.direction],
+                                            action.times))
+
+        self.out.write(PATH.pack("x", _encode_latency(latency), len(steps)))
+        self.out.write("".join(steps))
+
+    def placement(self, placement, latency=None):
+        if self._in_game:
+            self.out.write(PLACEMENT.pack("l", placement.rotation,
+                                          placement.x, placement.y,
+                                          _encode_latency(latency)))
+
+    def end_game(self, game_state):
+        if not self._in_game:
+            return
+
+        self.out.write(END.pack("e", game_state.completed_lines,
+                                game_state.board.zobrist_hash))
+        self.out.flush()
+        self._in_game = False
+
+    def close(self):
+        self.out.close()
+
+
+class _RecordedPieces(object):
+    """
+    Piece generator recording the blocks of another one.
+    """
+    def __init__(self, piece_generator, recorder):
+        self.piece_generator = piece_generator
+        self.recorder = recorder
+
+    def __call__(self):
+        block_class = self.piece_generator()
+        self.recorder.piece(block_class)
+        return block_class
+
+
+# type is "action", "path" or "placement". data is the action, the path (a list
+# of actions) or a RecordedPlacement, and latency is in seconds or None
+RecordedMove = collections.namedtuple("RecordedMove", "type data latency")
+RecordedPlacement = collections.namedtuple("RecordedPlacement",
+                                           "rotation x y")
+
+
+class GameRecording(object):
+    def __init__(self, seed, preview_size):
+        self.seed = seed
+        self.preview_size = preview_size
+        self.pieces = []
+        self.moves = []
+        # (lines, board hash) if the game was ended
+        self.end = None
+
+
+def read_recordings(f):
+    """
+    Returns the list of GameRecording in the binary file object `f`.
+    """
+    data = f.read()
+    games = []
+    game = None
+    i = 0
+
+    while i < len(data):
+        if data[i:i+4] == MAGIC:
+            magic, version, preview_size, has_seed, seed = \
+                HEADER.unpack_from(data, i)
+            assert version == VERSION, "Unknown recording version %d" % version
+            i += HEADER.size
+            game = GameRecording(seed if has_seed else None, preview_size)
+            games.append(game)
+            continue
+
+        assert game is not None, "Not a game recording"
+        event = data[i]
+        if event == "p":
+            _, kind = PIECE.unpack_from(data, i)
+            i += PIECE.size
+            game.pieces.append(BLOCKS[kind])
+        elif event == "a":
+            _, action = ACTION.unpack_from(data, i)
+            i += ACTION.size
+            game.moves.append(RecordedMove("action", action, None))
+        elif event == "x":
+            _, latency, steps = PATH.unpack_from(data, i)
+            i += PATH.size
+            path = []
+            for j in xrange(steps):
+                action, times = PATH_STEP.unpack_from(data, i)
+                i += PATH_STEP.size
+                path.append(_path_action(action, times))
+            game.moves.append(RecordedMove("path", path,
+                                           _decode_latency(latency)))
+        elif event == "l":
+            _, rotation, x, y, latency = PLACEMENT.unpack_from(data, i)
+            i += PLACEMENT.size
+            game.moves.append(RecordedMove("placement",
+                                           RecordedPlacement(rotation, x, y),
+                                           _decode_latency(latency)))
+        elif event == "e":
+            _, lines, board_hash = END.unpack_from(data, i)
+            i += END.size
+            game.end = (lines, board_hash)
+        else:
+            assert False, "Unknown event %r at byte %d" % (event, i)
+
+    return games
+
+
+def _path_action(action, times):
+    if action == HARD_DROP:
+        return HardDrop()
+    if action == ROTATE:
+        return Rotate(times)
+    for direction, a in _DIRECTIONS.iteritems():
+        if a == action:
+            return MakeMove(direction, times)
+    assert False, "Unknown path action %d" % action
+
+
+class ReplayResult(object):
+    def __init__(self, game_state, moves, latencies, replay_time, end):
+        self.game_state = game_state
+        self.lines = game_state.completed_lines
+        self.board_hash = game_state.board.zobrist_hash
+        self.game_over = game_state.game_is_over()
+        self.moves = moves
+        self.latencies = latencies
+        self.time = replay_time
+        self.end = end
+
+    @property
+    def matches(self):
+        """
+        True if the replay ended like the recorded game, None if the
+        recording has no end.
+        """
+        if self.end is None:
+            return None
+        return self.end == (self.lines, self.board_hash)
+
+    def __str__(self):
+        out = ["Lines: %d, moves: %d%s" % (
+                   self.lines, self.moves,
+                   ", game over" if self.game_over else ""),
+               "Replayed in %.3fs" % self.time]
+        if self.latencies:
+            latencies = sorted(self.latencies)
+            out.append("Decision time: mean %.2fms, max %.2fms" % (
+                sum(latencies) / len(latencies) * 1000, latencies[-1] * 1000))
+        if self.matches is not None:
+            out.append("Same end as recorded" if self.matches else
+                       "DIFFERENT END: recorded %d lines, hash %x" % self.end)
+        return "\n".join(out)
+
+
+def replay(recording, board_class=BitboardTetrisBoard):
+    """
+    Plays `recording` (a GameRecording) again and returns a ReplayResult.
+    """
+    pieces = iter(recording.pieces)
+    engine = HeadlessTetrisEngine(
+        board_class=board_class,
+        piece_generator_class=lambda seed: pieces.next,
+        preview_size=recording.preview_size)
+    game_state = engine.game_state
+
+    actions = {LEFT: game_state.move_block_left,
+               RIGHT: game_state.move_block_right,
+               DOWN: game_state.step_down,
+               ROTATE: game_state.rotate_block,
+               DROP: game_state.hard_drop}
+
+    latencies = []
+    start_time = time.time()
+    for move in recording.moves:
+        if move.latency is not None:
+            latencies.append(move.latency)
+
+        if move.type == "action":
+            actions[move.data]()
+        elif move.type == "path":
+            game_state.play_path(move.data)
+        else:
+            engine.step(move.data)
+
+    return ReplayResult(game_state, len(recording.moves), latencies,
+                        time.time() - start_time, recording.end)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("recording")
+    args = parser.parse_args(argv)
+
+    LOG.disable(LOG.DEBUG)
+
+    with open(args.recording, "rb") as f:
+        games = read_recordings(f)
+
+    different = 0
+    for i, game in enumerate(games):
+        result = replay(game)
+        print "Game %d (seed %s)" % (i, game.seed)
+        print result
+        different += int(result.matches is False)
+
+    return 1 if different else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
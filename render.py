@@ -0,0 +1,136 @@
+import sys
+import time
+import threading
+
+from log import LOG
+from metrics import METRICS
+
+CLEAR_SCREEN = "\033[H\033[J"
+
+
+def move_cursor(row, column):
+    """
+    Escape code to move the cursor, `row` and `column` start at 0.
+    """
+    return "\033[%d;%dH" % (row+1, column+1)
+
+
+class TerminalRenderer(object):
+    """
+    Draws frames (as returned by GameState.board_frame()) on the terminal.
+
+    The previous frame is kept and only the glyphs that changed since then
+    are written, at their position, with all the frame going out in a
+    single write.
+    """
+    def __init__(self, out=None):
+        self.out = out or sys.stdout
+        self._previous = None
+
+    def reset(self):
+        """
+        Forgets the previous frame, so the next one is drawn from scratch
+        (e.g. after something else wrote to the terminal).
+        """
+        self._previous = None
+
+    def render(self, game_state):
+        with METRICS.timer("render.time"):
+            self.draw(game_state.board_frame())
+
+    def draw(self, frame):
+        buf = []
+
+        previous = self._previous
+        if previous is None:
+            buf.append(CLEAR_SCREEN)
+            previous = []
+
+        for row, line in enumerate(frame):
+            if row >= len(previous) or len(previous[row]) != len(line):
+                buf.append(move_cursor(row, 0) + "".join(line) + "\033[K")
+                continue
+
+            old_line = previous[row]
+            column = 0
+            while column < len(line):
+                if line[column] == old_line[column]:
+                    column += 1
+                    continue
+
+                # write the changed glyphs that are together at once
+                start = column
+                while column < len(line) and line[column] != old_line[column]:
+                    column += 1
+                buf.append(move_cursor(row, start) + "".join(line[start:column]))
+
+        for row in xrange(len(frame), len(previous)):
+            buf.append(move_cursor(row, 0) + "\033[K")
+
+        self._previous = frame
+
+        if buf:
+            # leave the cursor below the frame
+            buf.append(move_cursor(len(frame), 0))
+            self.out.write("".join(buf))
+            self.out.flush()
+
+
+class RenderThread(object):
+    """
+    Draws the game on its own thread, so updating the game never waits for
+    the terminal.
+
+    notify() tells the thread the game changed. The thread then gets a
+    game state from `snapshot()` (which should be a cheap copy taken under
+    the game lock) and draws it, with the lock released. Changes that come
+    while a frame is being drawn, or faster than `max_fps` allows, are
+    merged into the next frame.
+    """
+    def __init__(self, snapshot, renderer=None, max_fps=30):
+        self.snapshot = snapshot
+        self.renderer = renderer or TerminalRenderer()
+        self.max_fps = max_fps
+
+        self._changed = threading.Event()
+        self._exiting = False
+        self._thread = threading.Thread(target=self._run_thread,
+                                        name="renderThread")
+        self._thread.daemon = True
+
+    def start(self):
+        self._thread.start()
+
+    def notify(self):
+        self._changed.set()
+
+    def stop(self):
+        """
+        Draws the last changes and stops the thread.
+        """
+        self._exiting = True
+        self._changed.set()
+        if self._thread.is_alive():
+            self._thread.join()
+
+    def _run_thread(self):
+        last_frame_time = 0
+        while True:
+            self._changed.wait()
+
+            if self.max_fps:
+                delay = last_frame_time + 1.0/self.max_fps - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+
+            self._changed.clear()
+            exiting = self._exiting
+
+            try:
+                self.renderer.render(self.snapshot())
+            except Exception:
+                LOG.debug("Render thread failed to draw a frame", exc_info=True)
+            last_frame_time = time.time()
+
+            if exiting:
+                break
@@ -0,0 +1,188 @@
+#!/usr/bin/python
+"""
+Self-play simulator: plays many headless games, each one with its own
+seeded block sequence, spread over a pool of processes, and aggregates the
+results as the games finish.
+
+    python simulate.py --games 1000 --processes 8 --sequence bag
+    python simulate.py --weights tuner_checkpoint.json
+"""
+import sys
+import time
+import argparse
+import multiprocessing
+
+from log import init_worker
+
+from engine import HeadlessTetrisEngine
+from pieces import PIECE_GENERATORS
+from ai import (PossiblePlacementsAlgorithm, LookaheadSearchAlgorithm,
+                BoardEvaluator)
+from metrics import Histogram
+import batcheval
+import tuner
+
+ALGORITHMS = {
+    "placements": PossiblePlacementsAlgorithm,
+    "lookahead": LookaheadSearchAlgorithm,
+}
+if batcheval.numpy is not None:
+    ALGORITHMS["batch"] = batcheval.BatchPlacementsAlgorithm
+
+
+def make_evaluator(algorithm_class, weights):
+    """
+    Returns the evaluator with `weights` for the searches of
+    `algorithm_class`, None (their default one) if `weights` is None.
+    """
+    if weights is None:
+        return None
+    if issubclass(algorithm_class, batcheval.BatchPlacementsAlgorithm):
+        return batcheval.BatchEvaluator(weights)
+    return BoardEvaluator(weights)
+
+
+def play_game(seed, sequence="uniform", algorithm="placements",
+              max_blocks=1000, preview_size=0, weights=None):
+    """
+    Plays a whole game with the AI and returns its results as a dict.
+    """
+    engine = HeadlessTetrisEngine(seed,
+                                  piece_generator_class=PIECE_GENERATORS[sequence],
+                                  preview_size=preview_size)
+    algorithm_class = ALGORITHMS[algorithm]
+    evaluator = make_evaluator(algorithm_class, weights)
+
+    lines = 0
+    # a histogram, so that workers don't have to send every time back
+    decision_times = Histogram()
+    start_time = time.time()
+
+    while engine.running() and engine.placed_blocks < max_blocks:
+        a = time.time()
+        search = algorithm_class(engine.game_state, evaluator=evaluator)
+        search.go()
+        decision_time = time.time()-a
+        decision_times.add(decision_time)
+
+        if search.best_result is None:
+            break
+        lines += engine.step(search.best_result.placement, decision_time)
+
+    return {"seed": seed,
+            "lines": lines,
+            "blocks": engine.placed_blocks,
+            "game_over": not engine.running(),
+            "time": time.time()-start_time,
+            "decision_times": decision_times}
+
+
+def _play_game_task(args):
+    return play_game(*args)
+
+
+class SimulationResults(object):
+    """
+    Aggregates the results of the games as they come.
+    """
+    def __init__(self):
+        self.games = 0
+        self.game_overs = 0
+        self.lines = []
+        self.blocks = 0
+        self.decision_times = Histogram()
+
+    def add(self, result):
+        self.games += 1
+        self.game_overs += int(result["game_over"])
+        self.lines.append(result["lines"])
+        self.blocks += result["blocks"]
+        self.decision_times.merge(result["decision_times"])
+
+    def __str__(self):
+        if not self.games:
+            return "<No games>"
+
+        lines = sorted(self.lines)
+        out = ["Games: %d (%d game overs)" % (self.games, self.game_overs),
+               "Lines: mean %.1f, min %d, median %d, max %d" % (
+                   float(sum(lines)) / len(lines), lines[0],
+                   lines[len(lines)/2], lines[-1]),
+               "Blocks: %d (%.1f per game)" % (
+                   self.blocks, float(self.blocks) / self.games)]
+        out.append("Decision time: " + ", ".join(
+            "p%d %.2fms" % (p, self.decision_times.percentile(p)*1000)
+            for p in (50, 90, 99, 100)))
+        return "\n".join(out)
+
+
+def simulate(games, processes=None, first_seed=0, sequence="uniform",
+             algorithm="placements", max_blocks=1000, preview_size=0,
+             log=False, progress=None, weights=None):
+    """
+    Plays `games` games with seeds first_seed, first_seed+1, ... over
+    `processes` processes (all the cores by default) and returns a
+    SimulationResults. The AI scores boards with `weights`, if given.
+
+    `progress`, if given, is called with the SimulationResults after each
+    game is aggregated.
+    """
+    results = SimulationResults()
+    tasks = [(seed, sequence, algorithm, max_blocks, preview_size, weights)
+             for seed in xrange(first_seed, first_seed+games)]
+
+    pool = multiprocessing.Pool(processes, init_worker, (log,))
+    try:
+        for result in pool.imap_unordered(_play_game_task, tasks):
+            results.add(result)
+            if progress:
+                progress(results)
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+    return results
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("-n", "--games", type=int, default=100)
+    parser.add_argument("-j", "--processes", type=int, default=None,
+                        help="number of processes (default: all the cores)")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="seed of the first game, the others follow")
+    parser.add_argument("--sequence", choices=sorted(PIECE_GENERATORS),
+                        default="uniform")
+    parser.add_argument("--algorithm", choices=sorted(ALGORITHMS),
+                        default="placements")
+    parser.add_argument("--max-blocks", type=int, default=1000,
+                        help="stop each game after this many blocks")
+    parser.add_argument("--preview", type=int, default=0,
+                        help="number of upcoming blocks known in advance")
+    parser.add_argument("--weights", metavar="CHECKPOINT",
+                        help="play with the best weights of a tuner.py "
+                             "checkpoint")
+    parser.add_argument("--log", action="store_true",
+                        help="keep the DEBUG logging of the games")
+    args = parser.parse_args(argv)
+
+    weights = tuner.load_weights(args.weights) if args.weights else None
+
+    def progress(results):
+        sys.stderr.write("\r%d/%d games" % (results.games, args.games))
+
+    start_time = time.time()
+    results = simulate(args.games, args.processes, args.seed, args.sequence,
+                       args.algorithm, args.max_blocks, args.preview,
+                       args.log, progress, weights)
+    sys.stderr.write("\n")
+
+    print results
+    print "Wall time: %.1fs" % (time.time()-start_time)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
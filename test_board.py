@@ -0,0 +1,185 @@
+"""
+Randomized checks of the metrics and the Zobrist hash the boards keep up
+to date incrementally, and of GameState.apply_placement()/undo(), against
+the same values computed from scratch from the squares.
+
+    python -m unittest test_board
+"""
+import random
+import unittest
+
+import board as board_module
+from board import TetrisBoard, BitboardTetrisBoard
+from blocks import BLOCKS
+from engine import GameState
+
+BOARD_CLASSES = (TetrisBoard, BitboardTetrisBoard)
+
+
+def recompute(board):
+    """
+    Returns the metrics of `board` computed from its squares only, in the
+    same form as snapshot().
+    """
+    squares = [[board.square_filled(x, y) for x in xrange(board.width)]
+               for y in xrange(board.height)]
+
+    heights, holes, covered = [], [], []
+    for x in xrange(board.width):
+        column = [squares[y][x] for y in xrange(board.height)]
+        height = max([y + 1 for y, filled in enumerate(column) if filled]
+                     or [0])
+        empty = [y for y in xrange(height) if not column[y]]
+        heights.append(height)
+        holes.append(len(empty))
+        covered.append(sum(column[min(empty)+1:]) if empty else 0)
+
+    keys = board_module._zobrist_keys(board.width, board.height)
+    zobrist_hash = 0
+    for y, row in enumerate(squares):
+        for x, filled in enumerate(row):
+            if filled:
+                zobrist_hash ^= keys[y][x]
+
+    return {"squares": squares,
+            "row_fill": [sum(row) for row in squares],
+            "heights": heights,
+            "column_holes": holes,
+            "column_covered": covered,
+            "holes": sum(holes),
+            "covered": sum(covered),
+            "aggregate_height": sum(heights),
+            "bumpiness": sum(abs(a - b) for a, b in zip(heights, heights[1:])),
+            "surface_profile": [b - a for a, b in zip(heights, heights[1:])],
+            "zobrist_hash": zobrist_hash}
+
+
+def snapshot(board):
+    """
+    Returns the metrics `board` keeps incrementally.
+    """
+    return {"squares": [[board.square_filled(x, y)
+                         for x in xrange(board.width)]
+                        for y in xrange(board.height)],
+            "row_fill": list(board.row_fill),
+            "heights": [board.column_height(x) for x in xrange(board.width)],
+            "column_holes": list(board.column_holes),
+            "column_covered": list(board.column_covered),
+            "holes": board.holes,
+            "covered": board.covered,
+            "aggregate_height": board.aggregate_height,
+            "bumpiness": board.bumpiness,
+            "surface_profile": list(board.surface_profile),
+            "zobrist_hash": board.zobrist_hash}
+
+
+def random_placement(board, rng):
+    """
+    Returns a random (block, (x, y)) resting on the stack of `board`, low
+    ones more likely so that lines get done, or None if nothing fits.
+    """
+    landings = []
+    block_class = rng.choice(BLOCKS)
+    for block in block_class.flyweights:
+        for x in xrange(-block.left_padding,
+                        board.width - block.width + block.right_padding + 1):
+            y = board.height - block.bottom_padding - 1
+            if not board.block_fits(block, (x, y)):
+                continue
+            while board.block_fits(block, (x, y-1)):
+                y -= 1
+            landings.append((y + block.bottom_padding, block, (x, y)))
+
+    if not landings:
+        return None
+    landings.sort()
+    if rng.random() < 0.7:
+        landings = landings[:3]
+    bottom, block, position = rng.choice(landings)
+    return block, position
+
+
+class IncrementalMetricsTest(unittest.TestCase):
+    PLACEMENTS = 400
+
+    def play(self, board_class, seed, check):
+        """
+        Applies random placements to an empty board of `board_class`,
+        starting over when it's full, calling `check(game_state, record)`
+        after each one.
+        """
+        rng = random.Random(seed)
+        game_state = GameState(board_class())
+        for i in xrange(self.PLACEMENTS):
+            placement = random_placement(game_state.board, rng)
+            if placement is None:
+                game_state = GameState(board_class())
+                continue
+            check(game_state, game_state.apply_placement(*placement))
+        return game_state
+
+    def test_metrics_match_recompute(self):
+        for board_class in BOARD_CLASSES:
+            lines = [0]
+            def check(game_state, record):
+                self.assertEqual(snapshot(game_state.board),
+                                 recompute(game_state.board))
+                lines[0] += record.lines_done
+            self.play(board_class, 1, check)
+            # the lines cleared must have been checked too
+            self.assertGreater(lines[0], 0)
+
+    def test_undo_restores_everything(self):
+        for board_class in BOARD_CLASSES:
+            rng = random.Random(2)
+            game_state = GameState(board_class())
+            # (record, metrics and lines before it) of the placements done
+            done = []
+            for i in xrange(self.PLACEMENTS):
+                placement = random_placement(game_state.board, rng)
+                if placement is None:
+                    game_state = GameState(board_class())
+                    del done[:]
+                    continue
+
+                before = (snapshot(game_state.board),
+                          game_state.completed_lines)
+                done.append((game_state.apply_placement(*placement), before))
+
+                if rng.random() < 0.3:
+                    for j in xrange(rng.randint(1, len(done))):
+                        record, (metrics, lines) = done.pop()
+                        game_state.undo(record)
+                        self.assertEqual(snapshot(game_state.board), metrics)
+                        self.assertEqual(recompute(game_state.board),
+                                         metrics)
+                        self.assertEqual(game_state.completed_lines, lines)
+
+    def test_board_classes_agree(self):
+        games = []
+        for board_class in BOARD_CLASSES:
+            boards = []
+            self.play(board_class, 3, lambda game_state, record:
+                      boards.append(snapshot(game_state.board)))
+            games.append(boards)
+        self.assertEqual(games[0], games[1])
+
+    def test_copy_is_independent(self):
+        for board_class in BOARD_CLASSES:
+            game_state = self.play(board_class, 4, lambda *args: None)
+            board = game_state.board
+            metrics = snapshot(board)
+            copy = board.copy()
+
+            rng = random.Random(5)
+            for i in xrange(20):
+                placement = random_placement(copy, rng)
+                if placement is None:
+                    break
+                copy.place_block(*placement)
+                self.assertEqual(snapshot(copy), recompute(copy))
+            self.assertEqual(snapshot(board), metrics)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,71 @@
+"""
+Record -> replay roundtrip of headless games: replaying a recording must
+end on the same lines and board as the recorded game.
+
+    python -m unittest test_recording
+"""
+import unittest
+from StringIO import StringIO
+
+from ai import PossiblePlacementsAlgorithm
+from engine import HeadlessTetrisEngine
+from recording import GameRecorder, read_recordings, replay
+
+
+def record_games(seeds, preview_size=0, max_blocks=60):
+    """
+    Plays a headless AI game per seed, recorded in memory, and returns
+    (the recording, the list of (lines, board hash) of the games).
+    """
+    out = StringIO()
+    engine = HeadlessTetrisEngine(seeds[0], preview_size=preview_size,
+                                  recorder=GameRecorder(out))
+    ends = []
+    for i, seed in enumerate(seeds):
+        if i:
+            engine.reset(seed)
+        while engine.running() and engine.placed_blocks < max_blocks:
+            search = PossiblePlacementsAlgorithm(engine.game_state)
+            search.go()
+            engine.step(search.best_result.placement,
+                        latency=0.001 * engine.placed_blocks)
+        engine.finish()
+        ends.append((engine.game_state.completed_lines,
+                     engine.game_state.board.zobrist_hash))
+    return out.getvalue(), ends
+
+
+class RecordingRoundtripTest(unittest.TestCase):
+    def test_replay_matches(self):
+        data, ends = record_games([1, 2, 3])
+        games = read_recordings(StringIO(data))
+
+        self.assertEqual([game.seed for game in games], [1, 2, 3])
+        for game, end in zip(games, ends):
+            self.assertEqual(game.end, end)
+            result = replay(game)
+            self.assertTrue(result.matches)
+            self.assertEqual((result.lines, result.board_hash), end)
+            self.assertEqual(result.moves, len(game.moves))
+            # latencies are kept to the microsecond
+            self.assertEqual([int(round(l * 1000000))
+                              for l in result.latencies],
+                             [i * 1000 for i in xrange(result.moves)])
+
+    def test_replay_with_preview(self):
+        data, ends = record_games([4], preview_size=2)
+        game, = read_recordings(StringIO(data))
+
+        self.assertEqual(game.preview_size, 2)
+        self.assertTrue(replay(game).matches)
+
+    def test_different_end_is_reported(self):
+        data, ends = record_games([5])
+        game, = read_recordings(StringIO(data))
+        game.moves.pop()
+
+        self.assertIs(replay(game).matches, False)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,195 @@
+"""
+Tracing for the hot paths of the game and the AI.
+
+A trace call only stores its format string and arguments in a ring buffer
+in memory, a background thread formats and writes them later to the log,
+so the traced code never waits for the formatting nor the file:
+
+    TRACE = get_tracer("engine")
+    TRACE.debug("Placing %s at %s", block, position)
+
+The arguments are formatted after the call returns, so they shouldn't be
+objects that change afterwards.
+
+Each component has its own level. They can be set with set_level() or
+with the TRACE_LEVELS environment variable, e.g. "search=INFO,board=DEBUG".
+Events that happen for each search node go through sampled(), which only
+keeps one in `sample_every`.
+
+logging.disable() (LOG.disable()) turns tracing off as well.
+"""
+import os
+import time
+import atexit
+import logging
+import threading
+from collections import deque
+
+from log import LOG
+
+DEBUG = logging.DEBUG
+INFO = logging.INFO
+WARNING = logging.WARNING
+ERROR = logging.ERROR
+
+DEFAULT_LEVEL = DEBUG
+# traces kept until the writer gets to them, older ones are dropped
+RING_SIZE = 100000
+# seconds between writes to the log
+WRITE_INTERVAL = 0.5
+# sampled() keeps one trace of every this many
+SAMPLE_EVERY = 100
+
+_levels = {}
+_tracers = {}
+_logging_manager = logging.getLogger().manager
+
+
+class TraceBuffer(object):
+    """
+    Ring buffer of traces, (time, thread name, component, level, format,
+    args) tuples. Appending is thread safe and never blocks.
+    """
+    def __init__(self, capacity=RING_SIZE):
+        self.records = deque(maxlen=capacity)
+        # traces dropped because the buffer was full (approximate)
+        self.dropped = 0
+
+    def append(self, record):
+        records = self.records
+        if len(records) == records.maxlen:
+            self.dropped += 1
+        records.append(record)
+
+    def drain(self):
+        """
+        Removes and returns the buffered traces, the oldest first.
+        """
+        records = self.records
+        drained = []
+        try:
+            while True:
+                drained.append(records.popleft())
+        except IndexError:
+            pass
+        return drained
+
+
+class TraceWriter(object):
+    """
+    Moves the traces of a TraceBuffer to the log every `interval` seconds,
+    from its own thread.
+    """
+    def __init__(self, buffer, interval=WRITE_INTERVAL):
+        self.buffer = buffer
+        self.interval = interval
+
+        self._logger = logging.getLogger()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def start(self):
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run_thread,
+                                            name="traceThread")
+            self._thread.daemon = True
+            self._thread.start()
+
+    def flush(self):
+        with self._lock:
+            for record in self.buffer.drain():
+                self._write(record)
+
+    def _write(self, record):
+        created, thread_name, component, level, msg, args = record
+        r = self._logger.makeRecord(self._logger.name, level, component, 0,
+                                    msg, args, None, func=component)
+        r.created = created
+        r.msecs = (created - int(created)) * 1000
+        r.threadName = thread_name
+        self._logger.handle(r)
+
+    def _run_thread(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.flush()
+            except Exception:
+                LOG.error("Failed to write traces", exc_info=True)
+
+
+BUFFER = TraceBuffer()
+WRITER = TraceWriter(BUFFER)
+atexit.register(WRITER.flush)
+
+
+class Tracer(object):
+    """
+    Traces of one component, get them with get_tracer().
+    """
+    def __init__(self, component, level=DEFAULT_LEVEL,
+                 sample_every=SAMPLE_EVERY):
+        self.component = component
+        self.level = level
+        self.sample_every = sample_every
+        self._sample_count = 0
+
+    # each method checks its level inline, not through a helper, so that
+    # a disabled trace costs no more than a comparison
+    def debug(self, msg, *args):
+        if DEBUG >= self.level and DEBUG > _logging_manager.disable:
+            self._trace(DEBUG, msg, args)
+
+    def info(self, msg, *args):
+        if INFO >= self.level and INFO > _logging_manager.disable:
+            self._trace(INFO, msg, args)
+
+    def warning(self, msg, *args):
+        if WARNING >= self.level and WARNING > _logging_manager.disable:
+            self._trace(WARNING, msg, args)
+
+    def error(self, msg, *args):
+        if ERROR >= self.level and ERROR > _logging_manager.disable:
+            self._trace(ERROR, msg, args)
+
+    def sampled(self, msg, *args):
+        """
+        debug() for events that happen too often to trace them all, only
+        one in `sample_every` is kept.
+        """
+        if DEBUG >= self.level and DEBUG > _logging_manager.disable:
+            self._sample_count += 1
+            if self._sample_count >= self.sample_every:
+                self._sample_count = 0
+                self._trace(DEBUG, msg, args)
+
+    def _trace(self, level, msg, args):
+        BUFFER.append((time.time(), threading.current_thread().name,
+                       self.component, level, msg, args))
+        if WRITER._thread is None:
+            WRITER.start()
+
+
+def get_tracer(component):
+    tracer = _tracers.get(component)
+    if tracer is None:
+        tracer = _tracers.setdefault(
+            component, Tracer(component, _levels.get(component, DEFAULT_LEVEL)))
+    return tracer
+
+
+def set_level(component, level):
+    _levels[component] = level
+    get_tracer(component).level = level
+
+
+def _parse_levels(spec):
+    for item in spec.split(","):
+        if "=" in item:
+            component, level = item.split("=", 1)
+            set_level(component.strip(),
+                      logging.getLevelName(level.strip().upper()))
+
+_parse_levels(os.environ.get("TRACE_LEVELS", ""))
@@ -0,0 +1,64 @@
+import threading
+from collections import OrderedDict
+
+
+class TranspositionTable(object):
+    """
+    Bounded cache for search results, usually keyed by the Zobrist hash of
+    a board (see TetrisBoard.zobrist_hash), alone or together with a block
+    kind.
+
+    When full, the least recently used entry is evicted. Lookups are
+    counted so the hit rate can be checked.
+    """
+    def __init__(self, capacity=100000):
+        self.capacity = capacity
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._entries.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+
+            # put it back as the most recently used one
+            self._entries[key] = value
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = value
+
+            if len(self._entries) > self.capacity:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = self.misses = self.evictions = 0
+
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        if not lookups:
+            return 0.0
+        return float(self.hits) / lookups
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __str__(self):
+        return "<TranspositionTable: %d/%d entries, %d hits, %d misses " \
+               "(%.1f%%), %d evictions>" % (len(self), self.capacity,
+                                            self.hits, self.misses,
+                                            self.hit_rate()*100,
+                                            self.evictions)
@@ -0,0 +1,270 @@
+#!/usr/bin/python
+"""
+Tunes the weights of ai.BoardEvaluator with the cross-entropy method, over
+seeded headless games played in parallel processes.
+
+Each generation samples a population of weight vectors from a normal
+distribution, plays the same games (same seeds) with every one of them and
+moves the distribution to the best ones (the elite). The optimizer state
+is saved after each generation, so a run can be stopped and resumed:
+
+    python tuner.py --generations 30 --population 32 --games 10
+    python tuner.py --resume
+
+The AIs play with the best weights found with --weights <checkpoint> (see
+game.py, simulate.py and host.py).
+
+Candidates clearly worse than the last elite stop playing after a few
+games, the tuning time goes to the promising ones.
+"""
+import os
+import sys
+import json
+import math
+import time
+import random
+import argparse
+import multiprocessing
+
+from log import init_worker
+
+from engine import HeadlessTetrisEngine
+from pieces import PIECE_GENERATORS
+from ai import BoardEvaluator, PossiblePlacementsAlgorithm
+from transposition import TranspositionTable
+
+DEFAULT_CHECKPOINT = "tuner_checkpoint.json"
+
+# a candidate stops after this many games if its mean lines are below this
+# fraction of the worst elite of the previous generation
+EARLY_STOP_GAMES = 3
+EARLY_STOP_RATIO = 0.5
+
+# noise added to the deviations of each generation, decreasing with the
+# generations, so the distribution doesn't collapse too soon
+EXTRA_NOISE = 0.1
+
+
+def _normalize(vector):
+    # scaling all the weights by the same positive number doesn't change
+    # which placement is the best, so vectors are kept with norm 1
+    norm = math.sqrt(sum(v*v for v in vector))
+    if not norm:
+        return list(vector)
+    return [v / norm for v in vector]
+
+
+def _weights(vector):
+    return dict(zip(BoardEvaluator.FEATURES, vector))
+
+
+def play_games(vector, seeds, sequence="uniform", max_blocks=500,
+               cutoff=None):
+    """
+    Plays a game per seed with the evaluator weights `vector` and returns
+    (mean lines, number of games played). If `cutoff` is given, stops early
+    when the mean falls below EARLY_STOP_RATIO * cutoff after
+    EARLY_STOP_GAMES games.
+    """
+    evaluator = BoardEvaluator.from_vector(vector, TranspositionTable())
+    lines = []
+
+    for seed in seeds:
+        engine = HeadlessTetrisEngine(
+            seed, piece_generator_class=PIECE_GENERATORS[sequence])
+        game_lines = 0
+        while engine.running() and engine.placed_blocks < max_blocks:
+            search = PossiblePlacementsAlgorithm(engine.game_state,
+                                                 evaluator=evaluator)
+            search.go()
+            if search.best_result is None:
+                break
+            game_lines += engine.step(search.best_result.placement)
+        lines.append(game_lines)
+
+        mean = float(sum(lines)) / len(lines)
+        if cutoff is not None and len(lines) >= EARLY_STOP_GAMES \
+                and mean < EARLY_STOP_RATIO * cutoff:
+            break
+
+    return float(sum(lines)) / len(lines), len(lines)
+
+
+def _play_games_task(args):
+    i, vector, seeds, sequence, max_blocks, cutoff = args
+    return (i,) + play_games(vector, seeds, sequence, max_blocks, cutoff)
+
+
+class CrossEntropyTuner(object):
+    """
+    Cross-entropy method state, which is all that has to be saved to
+    continue the tuning later.
+    """
+    def __init__(self, mean=None, std=None, seed=0, population=32,
+                 elite_fraction=0.25):
+        self.mean = _normalize(mean or BoardEvaluator().vector())
+        self.std = list(std or [0.5] * len(BoardEvaluator.FEATURES))
+        self.seed = seed
+        self.population = population
+        self.elite_fraction = elite_fraction
+
+        self.generation = 0
+        self.best_weights = _weights(self.mean)
+        self.best_lines = None
+        # mean lines of the worst elite candidate of the last generation
+        self.cutoff = None
+        self.history = []
+
+    def sample(self):
+        """
+        Returns the vectors of the population of the current generation,
+        always the same ones for the same generation and seed.
+        """
+        rng = random.Random("%s-%d" % (self.seed, self.generation))
+        return [_normalize([rng.gauss(m, s) for m, s in
+                            zip(self.mean, self.std)])
+                for i in xrange(self.population)]
+
+    def update(self, vectors, scores):
+        """
+        Moves the distribution to the elite of `vectors`, `scores` being
+        their mean lines.
+        """
+        ranked = sorted(zip(scores, vectors), reverse=True)
+        n = max(2, int(len(ranked) * self.elite_fraction))
+        elite = [v for s, v in ranked[:n]]
+
+        noise = EXTRA_NOISE / (self.generation + 1)
+        self.mean = _normalize([sum(v[i] for v in elite) / n
+                                for i in xrange(len(self.mean))])
+        self.std = [math.sqrt(sum((v[i] - m)**2 for v in elite) / n) + noise
+                    for i, m in enumerate(self.mean)]
+
+        best_score, best_vector = ranked[0]
+        if self.best_lines is None or best_score > self.best_lines:
+            self.best_lines = best_score
+            self.best_weights = _weights(best_vector)
+        self.cutoff = ranked[n-1][0]
+
+        self.history.append({"generation": self.generation,
+                             "best": best_score,
+                             "elite_mean": sum(s for s, v in ranked[:n]) / n,
+                             "cutoff": self.cutoff})
+        self.generation += 1
+
+    def to_dict(self):
+        return dict((k, getattr(self, k)) for k in
+                    ("mean", "std", "seed", "population", "elite_fraction",
+                     "generation", "best_weights", "best_lines", "cutoff",
+                     "history"))
+
+    @classmethod
+    def from_dict(cls, d):
+        tuner = cls(d["mean"], d["std"], d["seed"], d["population"],
+                    d["elite_fraction"])
+        for k in ("generation", "best_weights", "best_lines", "cutoff",
+                  "history"):
+            setattr(tuner, k, d[k])
+        return tuner
+
+    def save(self, path):
+        # written aside and renamed, a crash never leaves half a checkpoint
+        with open(path + ".tmp", "w") as f:
+            json.dump(self.to_dict(), f, indent=2, sort_keys=True)
+        os.rename(path + ".tmp", path)
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            return cls.from_dict(json.load(f))
+
+
+def load_weights(path):
+    """
+    Returns the best weights of the tuning saved at `path`, for
+    BoardEvaluator.
+    """
+    return CrossEntropyTuner.load(path).best_weights
+
+
+def tune(tuner, generations, games=10, processes=None, sequence="uniform",
+         max_blocks=500, checkpoint=None, progress=None):
+    """
+    Runs `generations` more generations of `tuner`. Each one plays `games`
+    games per candidate, with seeds that change every generation. The
+    tuner is saved to `checkpoint` after each generation, if given.
+
+    `progress`, if given, is called with the tuner after each generation.
+    """
+    pool = multiprocessing.Pool(processes, init_worker)
+    try:
+        for i in xrange(generations):
+            vectors = tuner.sample()
+            first_seed = tuner.seed * 1000003 + tuner.generation * games
+            seeds = range(first_seed, first_seed + games)
+
+            tasks = [(j, v, seeds, sequence, max_blocks,
+                      tuner.cutoff) for j, v in enumerate(vectors)]
+            scores = [None] * len(vectors)
+            for j, lines, played in pool.imap_unordered(_play_games_task,
+                                                       tasks):
+                scores[j] = lines
+
+            tuner.update(vectors, scores)
+            if checkpoint:
+                tuner.save(checkpoint)
+            if progress:
+                progress(tuner)
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+    return tuner
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("-g", "--generations", type=int, default=20)
+    parser.add_argument("-p", "--population", type=int, default=32)
+    parser.add_argument("--elite", type=float, default=0.25,
+                        help="fraction of the population kept as elite")
+    parser.add_argument("-n", "--games", type=int, default=10,
+                        help="games per candidate")
+    parser.add_argument("--max-blocks", type=int, default=500,
+                        help="stop each game after this many blocks")
+    parser.add_argument("-j", "--processes", type=int, default=None,
+                        help="number of processes (default: all the cores)")
+    parser.add_argument("--sequence", choices=sorted(PIECE_GENERATORS),
+                        default="uniform")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("-c", "--checkpoint", default=DEFAULT_CHECKPOINT)
+    parser.add_argument("--resume", action="store_true",
+                        help="continue from the checkpoint")
+    args = parser.parse_args(argv)
+
+    if args.resume:
+        tuner = CrossEntropyTuner.load(args.checkpoint)
+    else:
+        tuner = CrossEntropyTuner(seed=args.seed, population=args.population,
+                                  elite_fraction=args.elite)
+
+    def progress(tuner):
+        h = tuner.history[-1]
+        print "Generation %d: best %.1f, elite mean %.1f lines (%.0fs)" % (
+            h["generation"], h["best"], h["elite_mean"],
+            time.time() - start_time)
+        sys.stdout.flush()
+
+    start_time = time.time()
+    tune(tuner, args.generations, args.games, args.processes, args.sequence,
+         args.max_blocks, args.checkpoint, progress)
+
+    print "Best: %.1f lines with" % tuner.best_lines
+    print json.dumps(tuner.best_weights, indent=4, sort_keys=True)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])